@@ -0,0 +1,184 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from SaveEmissions import FORMATS, resultsLocation, readResults
+from CalculateEmissions import NO_TYPE
+
+# Python counterpart of MATLAB/emissions_city_pair.m. Flights are summed in
+# one grouped pass into an "aggregate": a table of sums and counts per
+# origin, destination, airline, airplane type and day of the week. As it
+# only holds sums, aggregates of different months can be merged by adding
+# them up, and every rollup (per route, airline, airplane type, day or
+# airport) is derived from the merged aggregate without revisiting flights.
+
+# Monthly aggregates are saved with this version in their name. Bump it
+# whenever what an aggregate holds changes, so that older ones are rebuilt.
+AGGREGATE_VERSION = 2
+
+# Finest grouping of an aggregate
+GROUP_COLUMNS = ['Origin', 'Dest', 'Reporting_Airline', 'Standard Code', 'DayOfWeek']
+
+# Per-flight quantities summed in an aggregate. 'CO2E per Seat' is each
+# flight's carbon footprint, Total CO2E / Number Seats.
+MEASURES = ['Total CO2', 'Total CO2E', 'CO2E per Seat', 'Number Seats', 'Distance', 'AirTime', 'TaxiIn',
+            'TaxiOut', 'DepDelay', 'ArrDelay', 'Origin LTO CO2', 'Origin LTO CO2e', 'Destination LTO CO2',
+            'Destination LTO CO2e']
+
+# Rollups that can be derived from an aggregate, by name
+ROLLUPS = {'route': ['Origin', 'Dest'],
+           'route-airline': ['Origin', 'Dest', 'Reporting_Airline'],
+           'route-airplane': ['Origin', 'Dest', 'Standard Code'],
+           'route-day': ['Origin', 'Dest', 'DayOfWeek'],
+           'airline': ['Reporting_Airline'],
+           'airplane': ['Standard Code'],
+           'day': ['DayOfWeek']}
+
+def aggregate(results, fleet=None):
+    # Inputs:
+    # results: DataFrame of flights with emissions, as written by
+    # emissions_batch
+    # fleet: FleetTable, used to find the airplane type of each flight
+    # (unknown if not given)
+
+    # Outputs:
+    # Aggregate of the flights: 'Flights' (flown, i.e. with an AirTime, as
+    # emissions_city_pair counts them), 'Scheduled Flights' (including
+    # cancelled and diverted ones) plus '<measure> sum' and '<measure> count'
+    # (flights where it is known) for every measure
+    results = results.copy()
+    for column in ['Origin', 'Dest', 'Reporting_Airline', 'Tail_Number']:
+        if isinstance(results[column].dtype, pd.CategoricalDtype):
+            results[column] = results[column].astype(object)
+    if 'Standard Code' not in results:
+        results['Standard Code'] = np.nan
+        if fleet is not None:
+            tailIDs = fleet.lookup(results['Tail_Number'])
+            types = fleet.types[tailIDs]
+            results['Standard Code'] = np.where((tailIDs >= 0) & (types != NO_TYPE), types, np.nan)
+    # Tails registered with no seats have no carbon footprint, and count as
+    # missing rather than infinite
+    results['CO2E per Seat'] = (results['Total CO2E'] / results['Number Seats']).where(results['Number Seats'] > 0)
+
+    measures = results[MEASURES].astype(float)
+    grouped = measures.groupby([results[c] for c in GROUP_COLUMNS], dropna=False, observed=True)
+    sums = grouped.sum().add_suffix(' sum')
+    counts = grouped.count().add_suffix(' count')
+    flights = counts['AirTime count'].rename('Flights')
+    scheduled = grouped.size().rename('Scheduled Flights')
+    return pd.concat([flights, scheduled, sums, counts], axis=1)
+
+def merge(*aggregates):
+    # Combines aggregates (e.g. the months of a quarter) into one
+    aggregates = [a for a in aggregates if a is not None]
+    return pd.concat(aggregates).groupby(level=GROUP_COLUMNS, dropna=False).sum()
+
+def aggregateResults(saveLoc, fleet=None, chunksize=500000):
+    # Aggregate of a results file written by CalculateEmissions.py, streamed
+    # chunksize flights at a time
+    columns = [c for c in GROUP_COLUMNS + MEASURES + ['Tail_Number'] if c != 'CO2E per Seat']
+    total = None
+    for chunk in readResults(saveLoc, columns=columns, chunksize=chunksize):
+        total = merge(total, aggregate(chunk, fleet))
+    return total
+
+def rollup(agg, by):
+    # Inputs:
+    # agg: aggregate, as returned by aggregate or merge
+    # by: list of GROUP_COLUMNS to group by
+
+    # Outputs:
+    # Totals and averages per group, together with each group's share of the
+    # flights, seats and CO2e of its parent group (e.g. the market share of an
+    # airline on a route, when grouping by route and airline)
+    sums = agg.groupby(level=by, dropna=False).sum()
+    summary = pd.DataFrame(index=sums.index)
+    summary['Flights'] = sums['Flights']
+    summary['Scheduled Flights'] = sums['Scheduled Flights']
+    for measure in ['Total CO2', 'Total CO2E', 'Number Seats', 'Origin LTO CO2', 'Origin LTO CO2e', 'Destination LTO CO2', 'Destination LTO CO2e']:
+        summary[measure] = sums[f'{measure} sum']
+    summary['CO2E per Seat'] = (sums['Total CO2E sum'] / sums['Number Seats sum']).where(sums['Number Seats sum'] > 0)
+    for measure in ['CO2E per Seat', 'Distance', 'AirTime', 'TaxiIn', 'TaxiOut', 'DepDelay', 'ArrDelay']:
+        summary[f'Average {measure}'] = sums[f'{measure} sum'] / sums[f'{measure} count']
+    summary['Average Flight Time'] = summary['Average AirTime'] + summary['Average TaxiIn'] + summary['Average TaxiOut']
+
+    for share, column in [('Flights Share', 'Flights'), ('Seats Share', 'Number Seats'), ('CO2E Share', 'Total CO2E')]:
+        if len(by) > 1:
+            parent = summary[column].groupby(level=by[:-1], dropna=False).transform('sum')
+        else:
+            parent = summary[column].sum()
+        summary[share] = 100 * summary[column] / parent
+    return summary
+
+def airportLTO(agg):
+    # Local LTO emissions of every airport: those of the flights departing from
+    # it (take-off, climb and taxi-out) plus those arriving at it (approach and
+    # taxi-in)
+    departing = agg.groupby(level='Origin')[['Flights', 'Origin LTO CO2 sum', 'Origin LTO CO2e sum']].sum()
+    arriving = agg.groupby(level='Dest')[['Flights', 'Destination LTO CO2 sum', 'Destination LTO CO2e sum']].sum()
+    airports = pd.DataFrame({'Departures': departing['Flights'],
+                             'Departure LTO CO2': departing['Origin LTO CO2 sum'],
+                             'Departure LTO CO2e': departing['Origin LTO CO2e sum']}).join(
+               pd.DataFrame({'Arrivals': arriving['Flights'],
+                             'Arrival LTO CO2': arriving['Destination LTO CO2 sum'],
+                             'Arrival LTO CO2e': arriving['Destination LTO CO2e sum']}), how='outer').fillna(0)
+    airports.index.name = 'Airport'
+    airports['LTO CO2'] = airports['Departure LTO CO2'] + airports['Arrival LTO CO2']
+    airports['LTO CO2e'] = airports['Departure LTO CO2e'] + airports['Arrival LTO CO2e']
+    return airports
+
+def aggregateLocation(YEAR, MONTH, outputFormat='csv'):
+    # Aggregates of the results of each format are kept apart, as a month can
+    # be saved in several formats
+    return f'Results/Aggregates/{outputFormat}/Aggregate{YEAR}_{MONTH}.v{AGGREGATE_VERSION}.csv'
+
+def saveAggregate(agg, saveLoc):
+    os.makedirs(os.path.dirname(saveLoc), exist_ok=True)
+    agg.to_csv(saveLoc)
+
+def loadAggregate(saveLoc):
+    return pd.read_csv(saveLoc, index_col=list(range(len(GROUP_COLUMNS))))
+
+def monthAggregate(YEAR, MONTH, outputFormat='csv', fleet=None):
+    # Aggregate of a month of results, saved next to them so that later
+    # quarters and years reuse it. It is recomputed if the results are newer.
+    resultsLoc = resultsLocation(YEAR, MONTH, outputFormat)
+    if not os.path.exists(resultsLoc):
+        raise FileNotFoundError(f'No {outputFormat} results for {MONTH}, {YEAR} ({resultsLoc}); calculate them first')
+    saveLoc = aggregateLocation(YEAR, MONTH, outputFormat)
+    if os.path.exists(saveLoc) and os.path.getmtime(saveLoc) >= os.path.getmtime(resultsLoc):
+        return loadAggregate(saveLoc)
+    agg = aggregateResults(resultsLoc, fleet)
+    saveAggregate(agg, saveLoc)
+    return agg
+
+if __name__ == '__main__':
+    from CalculateEmissions import readReferenceTables, monthRange
+
+    parser = argparse.ArgumentParser("Emissions Aggregation")
+    parser.add_argument("--from", dest="start", help="First month, as YYYY-MM", required=True)
+    parser.add_argument("--to", dest="end", help="Last month, as YYYY-MM (defaults to --from)")
+    parser.add_argument("--by", help="Rollup to compute", choices=list(ROLLUPS) + ['airport'], default='route')
+    parser.add_argument("--route", help="Only keep one route, given as ORIGIN DEST", nargs=2)
+    parser.add_argument("--format", help="Format the results were saved in", choices=FORMATS, default='csv')
+    parser.add_argument("--output", help="CSV to save the rollup to (printed if not given)")
+    args = parser.parse_args()
+
+    # Every month must have results, or the totals would silently leave some
+    # out
+    months = monthRange(args.start, args.end or args.start)
+    missing = [f'{YEAR}-{MONTH:02d}' for YEAR, MONTH in months if not os.path.exists(resultsLocation(YEAR, MONTH, args.format))]
+    if missing:
+        parser.exit(1, f'No {args.format} results for {", ".join(missing)}; calculate them first, or pass the --format they were saved in\n')
+
+    fleet, _, _ = readReferenceTables(None)
+    agg = merge(*[monthAggregate(YEAR, MONTH, args.format, fleet) for YEAR, MONTH in months])
+    if args.route:
+        agg = agg.xs(tuple(args.route), level=['Origin', 'Dest'], drop_level=False)
+
+    summary = airportLTO(agg) if args.by == 'airport' else rollup(agg, ROLLUPS[args.by])
+    if args.output:
+        summary.to_csv(args.output)
+    else:
+        with pd.option_context('display.max_rows', 200, 'display.width', 200):
+            print(summary)
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+import numpy as np
+import pandas as pd
+import CalculateEmissions
+from CalculateEmissions import (readReferenceTables, emissions_batch, emissions_stream, flight_emissions,
+                                EmissionsCache, ONTIME_COLUMNS)
+from SaveEmissions import EmissionsWriter, EMISSIONS_COLUMNS
+
+# Benchmarks of the emissions pipeline on synthetic On-Time data, so that
+# performance can be measured without downloading a month from BTS. Results
+# can be saved as a JSON baseline (committed alongside the code, so that
+# regressions show up in a diff) and compared against on later runs.
+
+AIRLINES = ['AA', 'AS', 'B6', 'DL', 'F9', 'G4', 'HA', 'MQ', 'NK', 'OH', 'OO', 'QX', 'UA', 'WN', 'YV', 'YX', '9E']
+AIRPORTS = ['ATL', 'BOS', 'CLT', 'DCA', 'DEN', 'DFW', 'DTW', 'EWR', 'IAH', 'JFK', 'LAS', 'LAX', 'LGA', 'MCO',
+            'MIA', 'MSP', 'ORD', 'PHL', 'PHX', 'SAN', 'SEA', 'SFO', 'SLC', 'TPA']
+
+def syntheticOnTime(flights, fleet, unmatchedShare=0.05, missingAirTimeShare=0.02, seed=0):
+    # Inputs:
+    # flights: number of rows to generate
+    # fleet: FleetTable the registered tail numbers are drawn from
+    # unmatchedShare: share of flights whose tail number isn't registered
+    # missingAirTimeShare: share of flights without an AirTime (e.g. cancelled)
+    # seed: random seed
+
+    # Outputs:
+    # DataFrame with the ONTIME_COLUMNS of the On-Time dataset. Taxi and air
+    # times are whole minutes, drawn from right-skewed distributions close to
+    # those of domestic flights (median taxi-out ~15 min, taxi-in ~6 min,
+    # air time ~95 min).
+    rng = np.random.default_rng(seed)
+    tails = fleet.tails.astype(object)
+    tailCodes = rng.integers(0, len(tails), flights)
+    unmatched = rng.random(flights) < unmatchedShare
+    tailNames = np.append(tails, [f'NX{i:04d}' for i in range(1000)])
+    tailCodes[unmatched] = len(tails) + rng.integers(0, 1000, unmatched.sum())
+
+    airTime = np.clip(np.round(rng.gamma(2.5, 40, flights)), 15, 700)
+    airTime[rng.random(flights) < missingAirTimeShare] = np.nan
+    origin = rng.integers(0, len(AIRPORTS), flights)
+    dest = (origin + rng.integers(1, len(AIRPORTS), flights)) % len(AIRPORTS)
+    days = rng.integers(1, 29, flights)
+
+    return pd.DataFrame({'Year': 2021, 'Month': 2, 'DayofMonth': days, 'DayOfWeek': (days - 1) % 7 + 1,
+                         'FlightDate': pd.Categorical.from_codes(days - 1, [f'2021-02-{d:02d}' for d in range(1, 29)]),
+                         'Reporting_Airline': pd.Categorical.from_codes(rng.integers(0, len(AIRLINES), flights), AIRLINES),
+                         'Flight_Number_Reporting_Airline': rng.integers(1, 7000, flights),
+                         'Tail_Number': pd.Categorical.from_codes(tailCodes, tailNames),
+                         'Origin': pd.Categorical.from_codes(origin, AIRPORTS),
+                         'Dest': pd.Categorical.from_codes(dest, AIRPORTS),
+                         'DepDelay': np.round(rng.normal(0, 10, flights) + rng.exponential(8, flights)),
+                         'ArrDelay': np.round(rng.normal(-5, 10, flights) + rng.exponential(8, flights)),
+                         'TaxiOut': np.clip(np.round(rng.lognormal(np.log(15), 0.45, flights)), 1, 180),
+                         'TaxiIn': np.clip(np.round(rng.lognormal(np.log(6), 0.55, flights)), 1, 120),
+                         'AirTime': airTime,
+                         'Distance': np.round(airTime * 7.5 + 30)})[ONTIME_COLUMNS]
+
+def measure(function, repeat=1, memory=True):
+    # Best wall time of `repeat` calls of function, and the peak memory it
+    # allocated (measured on a separate, traced call)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return min(times), peak
+
+@contextlib.contextmanager
+def scratchCache():
+    # Points the reference-table cache at a temporary directory, so that
+    # rebuilding it doesn't touch the live cache, which running backfills and
+    # the estimate service may have mapped
+    liveCache = CalculateEmissions.CACHE_DIR
+    with tempfile.TemporaryDirectory() as directory:
+        CalculateEmissions.CACHE_DIR = directory
+        try:
+            yield
+        finally:
+            CalculateEmissions.CACHE_DIR = liveCache
+
+def runBenchmarks(sizes, repeat=3, memory=True, scalarFlights=2000, unmatchedShare=0.05, missingAirTimeShare=0.02):
+    # Runs every benchmark, returning {benchmark: {metric: value}}.
+    # unmatchedShare and missingAirTimeShare shape the synthetic months (see
+    # syntheticOnTime); the per-flight benchmarks only use registered tails.
+    results = {}
+
+    with scratchCache():
+        seconds, peak = measure(lambda: readReferenceTables(None, rebuildCache=True), 1, memory)
+        results['reference tables (cold)'] = {'seconds': seconds, 'peak MB': peak and peak / 2**20}
+        seconds, peak = measure(lambda: readReferenceTables(None), repeat, memory)
+        results['reference tables (cached)'] = {'seconds': seconds, 'peak MB': peak and peak / 2**20}
+    fleet, ltoRates, ccdIndex = tables = readReferenceTables(None)
+
+    # Per-flight path, uncached and memoized in an EmissionsCache, both empty
+    # (every flight a miss) and warm (every flight a hit)
+    onTime = syntheticOnTime(scalarFlights, fleet, unmatchedShare=0, missingAirTimeShare=0)
+    entries = [fleet.entry(ID) for ID in fleet.lookup(onTime['Tail_Number'])]
+    def scalar(cache=None):
+        for entry, taxiIn, taxiOut, airTime in zip(entries, onTime['TaxiIn'], onTime['TaxiOut'], onTime['AirTime']):
+            flight_emissions(entry['FAA Engine Code'], entry['Standard Code'], taxiIn, taxiOut, airTime, ltoRates, ccdIndex, cache=cache)
+    warmCache = EmissionsCache()
+    scalar(warmCache)
+    for name, run in [('flight_emissions', scalar), ('flight_emissions (cold cache)', lambda: scalar(EmissionsCache())),
+                      ('flight_emissions (warm cache)', lambda: scalar(warmCache))]:
+        seconds, _ = measure(run, repeat, False)
+        results[name] = {'flights': scalarFlights, 'seconds': seconds, 'flights/s': scalarFlights / seconds}
+
+    for size in sizes:
+        onTime = syntheticOnTime(size, fleet, unmatchedShare, missingAirTimeShare)
+        seconds, peak = measure(lambda: emissions_batch(onTime.copy(), fleet, ltoRates, ccdIndex), repeat, memory)
+        results[f'emissions_batch {size}'] = {'flights': size, 'seconds': seconds, 'flights/s': size / seconds, 'peak MB': peak and peak / 2**20}
+
+        # Streaming, from and to CSV on disk
+        with tempfile.TemporaryDirectory() as directory:
+            onTimeLoc = os.path.join(directory, 'OnTime.csv')
+            onTime.to_csv(onTimeLoc, index=False)
+            def stream():
+                with EmissionsWriter(os.path.join(directory, 'Emissions.csv'), 'csv', ONTIME_COLUMNS + EMISSIONS_COLUMNS) as writer:
+                    emissions_stream(onTimeLoc, writer, tables, chunksize=100000)
+            seconds, peak = measure(stream, 1, memory)
+        results[f'emissions_stream {size}'] = {'flights': size, 'seconds': seconds, 'flights/s': size / seconds, 'peak MB': peak and peak / 2**20}
+    return results
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+def saveBaseline(results, saveLoc):
+    # Rounded and sorted, so that the file diffs cleanly between runs
+    rounded = {name: {metric: (round(value, 4) if isinstance(value, float) else value) for metric, value in sorted(metrics.items()) if value is not None}
+               for name, metrics in sorted(results.items())}
+    os.makedirs(os.path.dirname(saveLoc) or '.', exist_ok=True)
+    with open(saveLoc, 'w') as f:
+        json.dump({'environment': environment(), 'results': rounded}, f, indent=2)
+        f.write('\n')
+
+def compareBaseline(results, baselineLoc, tolerance=0.2):
+    # Prints every benchmark next to its baseline. Returns the benchmarks more
+    # than `tolerance` slower (or using more than `tolerance` more memory).
+    with open(baselineLoc) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric in ['seconds', 'peak MB']:
+            old, new = baseline[name].get(metric), metrics.get(metric)
+            if old and new:
+                change = new / old - 1
+                flag = '  REGRESSION' if change > tolerance else ''
+                print(f'{name:40s} {metric:8s} {old:12.4f} -> {new:12.4f} ({change:+.0%}){flag}')
+                if flag:
+                    regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Emissions Benchmarks")
+    parser.add_argument("--sizes", help="Numbers of synthetic flights to benchmark", type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--repeat", help="Timed runs per benchmark (the best is kept)", type=int, default=3)
+    parser.add_argument("--unmatched-share", help="Share of synthetic flights whose tail number isn't registered", type=float, default=0.05)
+    parser.add_argument("--missing-airtime-share", help="Share of synthetic flights without an AirTime", type=float, default=0.02)
+    parser.add_argument("--no-memory", help="Skip the traced runs measuring peak memory", action="store_true")
+    parser.add_argument("--save-baseline", help="JSON file to save the results to, e.g. Benchmarks/baseline.json")
+    parser.add_argument("--compare", help="Baseline JSON file to compare the results against")
+    parser.add_argument("--tolerance", help="Slowdown flagged as a regression when comparing", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.sizes, args.repeat, not args.no_memory, unmatchedShare=args.unmatched_share,
+                            missingAirTimeShare=args.missing_airtime_share)
+    print(pd.DataFrame(results).T.to_string(float_format=lambda x: f'{x:,.4f}'))
+    if args.compare:
+        regressions = compareBaseline(results, args.compare, args.tolerance)
+    if args.save_baseline:
+        saveBaseline(results, args.save_baseline)
+    if args.compare and regressions:
+        sys.exit(f'{len(regressions)} benchmarks regressed')
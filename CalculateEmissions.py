@@ -1,16 +1,59 @@
 import pandas as pd
 import os
 import numpy as np
-from tqdm import tqdm
 import math
 import pickle
-import requests
-import zipfile
+import hashlib
+import shutil
+import sys
+import time
+import concurrent.futures
+import collections
+import json
 import argparse
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-def emissions_calc(FAAcode, airplane, timeTakeoff, timeClimb, timeApproach, timeTaxiIn, timeTaxiOut, timeCCD, ltoTableDict, ccdTable, backupDict):
+from DownloadOnTime import BTS_URL, downloadMonth, downloadMonths, openOnTimeCSV
+from SaveEmissions import FORMATS, EMISSIONS_COLUMNS, EmissionsWriter, resultsLocation, partialLocation
+from RunMetrics import metrics, profiled, printProfile, saveReport
+
+# Standard LTO times, in seconds
+TIME_TAKEOFF = 42
+TIME_CLIMB = 132
+TIME_APPROACH = 240
+
+# Per-engine LTO rates used from the ICAO Emissions Databank, in the order
+# HC, CO, NOx, Fuel, CO2 x take-off, climb, approach, idle
+LTO_RATE_COLUMNS = ['HC T/O (kg)', 'HC C/O (kg/s)', 'HC App (kg/s)', 'HC Idle (kg/s)',
+                    'CO T/O (kg/s)', 'CO C/O (kg/s)', 'CO App (kg/s)', 'CO Idle (kg/s)',
+                    'NOx T/O (kg/s)', 'NOx C/O (kg/s)', 'NOx App (kg/s)', 'NOx Idle (kg/s)',
+                    'Fuel Flow T/O (kg/sec)', 'Fuel Flow C/O (kg/sec)', 'Fuel Flow App (kg/sec)', 'Fuel Flow Idle (kg/sec)',
+                    'CO2 T/O (kg/s)', 'CO2 C/O (kg/s)', 'CO2 App (kg/s)', 'CO2 Idle (kg/s)']
+
+# Columns used from the Engine Fuel Consumption table for the CCD cycle
+CCD_COLUMNS = ['Distance (nm)','Duration (min)','Fuel Burnt (kg)','CO2 (kg)','NOX (kg)','SOX (kg)','H20 (kg)','CO (kg)','HC  (kg)']
+
+# Columns of the On-Time dataset read when streaming: the inputs of
+# emissions_batch plus the flight identifiers kept alongside the emissions
+ONTIME_COLUMNS = ['Year', 'Month', 'DayofMonth', 'DayOfWeek', 'FlightDate', 'Reporting_Airline',
+                  'Flight_Number_Reporting_Airline', 'Tail_Number', 'Origin', 'Dest', 'DepDelay',
+                  'ArrDelay', 'TaxiOut', 'TaxiIn', 'AirTime', 'Distance']
+ONTIME_DTYPES = {'FlightDate': str, 'Reporting_Airline': str, 'Tail_Number': str, 'Origin': str, 'Dest': str,
+                 'DepDelay': float, 'ArrDelay': float, 'TaxiOut': float, 'TaxiIn': float, 'AirTime': float, 'Distance': float}
+
+# Source workbooks in ReferenceTables/ that the compiled tables are built from
+REFERENCE_TABLES = ['Aircraft By Airline.csv', 'ICAO Emissions Databank.xlsx', 'Engine Fuel Consumption.xlsx',
+                    'Master Airplane Engine Table.xlsx', 'LTO Backup.xlsx']
+
+# Compiled reference tables are cached here, keyed on the sources' contents.
+# Bump CACHE_VERSION whenever the compiled layout changes.
+CACHE_DIR = 'ReferenceTables/.cache'
+CACHE_VERSION = 3
+
+# Snapshots of the compiled reference tables that stored results were
+# calculated with are kept here (see recordDependencies and
+# UpdateEmissions.py)
+DEPENDENCIES_DIR = 'Results/Dependencies'
+
+def emissions_calc(FAAcode, airplane, timeTakeoff, timeClimb, timeApproach, timeTaxiIn, timeTaxiOut, timeCCD, ltoRates, ccdIndex):
     # Inputs:
     # FAAcode: FAA engine code
     # airplane: airplane type code
@@ -19,9 +62,8 @@ def emissions_calc(FAAcode, airplane, timeTakeoff, timeClimb, timeApproach, time
     # timeApproach: time during approach and landing, in seconds
     # timeIdle: time during taxi-in and taxi-out, in seconds
     # timeCCD: time during cruising, in minutes
-    # ltoTable: table containing emissions data for the LTO cycle
-    # ccdTable: table containing emissions data for the CCD cycle
-    # backupDict: FILL IN
+    # ltoRates: per-engine LTO emission rates, as built by compileLTOrates
+    # ccdIndex: CCD emissions data per airplane type, as built by compileCCDtable
 
     # Outputs:
     # Total_CO2: total amount of CO2 emitted
@@ -39,93 +81,31 @@ def emissions_calc(FAAcode, airplane, timeTakeoff, timeClimb, timeApproach, time
     ###########################################################################
     # LTO Cycle Emissions Calculations                                        #
     ###########################################################################
-    # Finding the lto_table entries corresponding to the desired FAA code
-    UIDs = []
-    for k,v in ltoTableDict['FAA Code'].items():
-        if v == FAAcode:
-            UIDs.append(k)
-
-    # If it happens that for some reason the engine FAA_code doesn't match with
-    # any of the ones we got, then we consider the following back-up
-    if len(UIDs) == 0:
-        if airplane in backupDict['FAA Engine Code']:
-            FAAcode = backupDict['FAA Engine Code'][airplane]
-            for k,v in ltoTableDict['FAA Code'].items():
-                if v == FAAcode:
-                    UIDs.append(k)
-    # Using the indeces, we find the average value of the emissions for the
-    # particular engine type. For that, we first construct a smaller, 20-column 
-    # table, containing the following information in each column, as shown in
-    # the for loop below. Notice that the number next to each entry corresponds 
-    # to the column number from the excel table
-    if len(UIDs) == 0:
+    # Finding the compiled rates corresponding to the desired FAA code. If it
+    # happens that for some reason the engine FAA code doesn't match with any
+    # of the ones we got, then we consider the LTO Backup engine for the
+    # airplane type instead (already resolved by compileLTOrates)
+    row = ltoRates['Row'].get(FAAcode, ltoRates['Backup Row'].get(airplane, -1))
+
+    if row < 0:
         Total_CO2_lto, Total_CO2e_lto, origin_em, origin_em_eq, destination_em, destination_em_eq, Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_CO2_lto, Total_CO2_ccd, Total_NOx_ccd, Total_SOx_ccd, Total_H2O_ccd, Total_CO_ccd, Total_HC_ccd = 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
     else:
-        lto_em_table = np.zeros((len(UIDs),20));
-        # Filling the table up
-        # 'HC EI T/O (g/kg)', 'HC T/O (kg)', 'HC T/O (kg/s)', 'HC EI C/O (g/kg)', 'HC C/O (kg)', 'HC C/O (kg/s)', 'HC EI App (g/kg)', 'HC App (kg)', 'HC App (kg/s)', 'HC EI Idle (g/kg)', 'HC Idle (kg)', 'HC Idle (kg/s)', 'HC LTO Total mass (g)', 'CO EI T/O (g/kg)', 'CO T/O (kg)', 'CO T/O (kg/s)', 'CO EI C/O (kg/s)', 'CO C/O (kg)', 'CO C/O (kg/s)', 'CO EI App (g/kg)', 'CO App (kg)', 'CO App (kg/s)', 'CO EI Idle (g/kg)', 'CO Idle (kg)', 'CO Idle (kg/s)', 'CO LTO Total Mass (g)', 'NOx EI T/O (g/kg)', 'NOx T/O (kg)', 'NOx T/O (kg/s)', 'NOx EI C/O (g/kg)', 'NOx C/O (kg)', 'NOx C/O (kg/s)', 'NOx EI App (g/kg)', 'NOx App (kg)', 'NOx App (kg/s)', 'NOx EI Idle (g/kg)', 'NOx Idle (kg)', 'NOx Idle (kg/s)', 'NOx LTO Total mass (g)'
-        for i, id in enumerate(UIDs):
-            rates = []
-
-            rates.append(ltoTableDict['HC T/O (kg)'][id])
-            rates.append(ltoTableDict['HC C/O (kg/s)'][id])
-            rates.append(ltoTableDict['HC App (kg/s)'][id])
-            rates.append(ltoTableDict['HC Idle (kg/s)'][id])
-            rates.append(ltoTableDict['CO T/O (kg/s)'][id])
-            rates.append(ltoTableDict['CO C/O (kg/s)'][id])
-            rates.append(ltoTableDict['CO App (kg/s)'][id])
-            rates.append(ltoTableDict['CO Idle (kg/s)'][id])
-            rates.append(ltoTableDict['NOx T/O (kg/s)'][id])
-            rates.append(ltoTableDict['NOx C/O (kg/s)'][id])
-            rates.append(ltoTableDict['NOx App (kg/s)'][id])
-            rates.append(ltoTableDict['NOx Idle (kg/s)'][id])
-            rates.append(ltoTableDict['Fuel Flow T/O (kg/sec)'][id])
-            rates.append(ltoTableDict['Fuel Flow C/O (kg/sec)'][id])
-            rates.append(ltoTableDict['Fuel Flow App (kg/sec)'][id])
-            rates.append(ltoTableDict['Fuel Flow Idle (kg/sec)'][id])
-            rates.append(ltoTableDict['CO2 T/O (kg/s)'][id])
-            rates.append(ltoTableDict['CO2 C/O (kg/s)'][id])
-            rates.append(ltoTableDict['CO2 App (kg/s)'][id])
-            rates.append(ltoTableDict['CO2 Idle (kg/s)'][id])
-            
-
-
-            # Ask if there is any entry that has a NaN in it and replace it with a
-            # 0 instead
-            cleanedRates = []
-            for r in rates:
-                if pd.isna(r):
-                    cleanedRates.append(0)
-                else:
-                    cleanedRates.append(r)
-            lto_em_table[i,:] = cleanedRates
-
-        # After filling up the table, we can take the average value across each
-        # column (for the case where multiple engines correspond to the same FAA
-        # code):
-        lto_em = np.mean(lto_em_table, axis=0)
+        # The rates of the engine are a (species, phase) table, with species
+        # HC, CO, NOx, Fuel, CO2 and phases take-off, climb, approach, idle
+        lto_em = ltoRates['Rates'][row]
 
         # Now, it is possible to calculate the emissions from the LTO cycle. This
         # is a simple calculation, that involves multiplying the specific LTO time
         # by the emission factor from the "em" table
         timeIdle = timeTaxiIn + timeTaxiOut
-        Total_HC_lto = timeTakeoff*lto_em[0] + timeClimb*lto_em[1] + timeApproach*lto_em[2] + timeIdle*lto_em[3]
-        Total_CO_lto = timeTakeoff*lto_em[4] + timeClimb*lto_em[5] + timeApproach*lto_em[6] + timeIdle*lto_em[7]
-        Total_NOx_lto = timeTakeoff*lto_em[8] + timeClimb*lto_em[9] + timeApproach*lto_em[10] + timeIdle*lto_em[11]
-        Total_Fuel_lto = timeTakeoff*lto_em[12] + timeClimb*lto_em[13] + timeApproach*lto_em[14] + timeIdle*lto_em[15]
-        Total_CO2_lto = timeTakeoff*lto_em[16] + timeClimb*lto_em[17] + timeApproach*lto_em[18] + timeIdle*lto_em[19]
-        
-        origin_em = timeTakeoff*lto_em[16] + timeClimb*lto_em[17] + timeTaxiOut*lto_em[19]
-        destination_em = timeApproach*lto_em[18] + timeTaxiIn*lto_em[19]
-
-        origin_em_eq = HC_2_CO2*(timeTakeoff*lto_em[0] + timeClimb*lto_em[1] + timeTaxiOut*lto_em[3]) + CO_2_CO2*(timeTakeoff*lto_em[4] + timeClimb*lto_em[5] + timeTaxiOut*lto_em[7]) + NOx_2_CO2*(timeTakeoff*lto_em[8] + timeClimb*lto_em[9] + timeTaxiOut*lto_em[11]) + (timeTakeoff*lto_em[16] + timeClimb*lto_em[17] + timeTaxiOut*lto_em[19])
-        destination_em_eq = HC_2_CO2*(timeApproach*lto_em[2] + timeTaxiIn*lto_em[3]) + CO_2_CO2*(timeApproach*lto_em[6] + timeTaxiIn*lto_em[7]) + NOx_2_CO2*(timeApproach*lto_em[10] + timeTaxiIn*lto_em[11]) + (timeApproach*lto_em[18] + timeTaxiIn*lto_em[19])
+        Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_Fuel_lto, Total_CO2_lto = lto_em @ np.array([timeTakeoff, timeClimb, timeApproach, timeIdle])
+        origin = lto_em @ np.array([timeTakeoff, timeClimb, 0, timeTaxiOut])
+        destination = lto_em @ np.array([0, 0, timeApproach, timeTaxiIn])
+
+        equivalent = np.array([HC_2_CO2, CO_2_CO2, NOx_2_CO2, 0, 1])
+        origin_em, origin_em_eq = origin[4], origin @ equivalent
+        destination_em, destination_em_eq = destination[4], destination @ equivalent
 
-        # And having done this, it is possible to compute the total carbon
-        # equivalent emissions from all four types of gases combined. Recall from
-        # above that HC_2_CO2, CO_2_CO2 and NOx_2_CO2 are the conversion factors
-        # from the impact of HC, CO and NOx in terms of CO2, respectively. Overall,
-        # we get that:
         Total_CO2e_lto = HC_2_CO2*Total_HC_lto + CO_2_CO2*Total_CO_lto + NOx_2_CO2*Total_NOx_lto + Total_CO2_lto
     ###########################################################################
 
@@ -133,65 +113,12 @@ def emissions_calc(FAAcode, airplane, timeTakeoff, timeClimb, timeApproach, time
     ###########################################################################
     # CCD Cycle Emissions Calculations                                        #
     ###########################################################################
-    # Finding the ccd_table entries corresponding to the desired airplane type
-    CCDairplanes = CCDtable[CCDtable['Standard Code'] == airplane]
-
-    # Using the indeces, we construct a smaller, 9-column table, containing the 
-    # following information in each column, as shown in the for loop below. 
-    # Notice that the number next to each entry corresponds to the column 
-    # number from the excel table
-
-    # Filling the table up
-    CCDairplanes = CCDairplanes
-    ccd_em_table = CCDairplanes[['Distance (nm)','Duration (min)','Fuel Burnt (kg)','CO2 (kg)','NOX (kg)','SOX (kg)','H20 (kg)','CO (kg)','HC  (kg)']].fillna(0).to_numpy()
-    if ccd_em_table.shape[0] > 0:
+    # Finding the ccd table entries corresponding to the desired airplane type
+    if airplane in ccdIndex:
         # Now, it is possible to calculate the emissions from the CCD cycle. This
-        # is a simple interpolation calculation, that goes as follows. However, we 
-        # first need to find the interval in which the ccd time falls into. For
-        # that, we consider the following for loop:
-        low_ind = 0
-        high_ind = 0
-        for i in range(ccd_em_table.shape[0]-1):
-            if timeCCD > ccd_em_table[i,1] and timeCCD < ccd_em_table[i+1,1]:
-                low_ind = i
-                high_ind = i + 1
-        if timeCCD < ccd_em_table[0,1]:
-            # Flight time is smaller than the first entry
-            Total_Fuel_ccd = ccd_em_table[0,2]
-            Total_CO2_ccd = ccd_em_table[0,3]
-            Total_NOx_ccd = ccd_em_table[0,4]
-            Total_SOx_ccd = ccd_em_table[0,5]
-            Total_H2O_ccd = ccd_em_table[0,6]
-            Total_CO_ccd = ccd_em_table[0,7]
-            Total_HC_ccd = ccd_em_table[0,8]
-        elif timeCCD > ccd_em_table[ccd_em_table.shape[0]-1,1]:
-            # Flight time is larger than the max entry
-            Total_Fuel_ccd = ccd_em_table[ccd_em_table.shape[0]-1,2]
-            Total_CO2_ccd = ccd_em_table[ccd_em_table.shape[0]-1,3]
-            Total_NOx_ccd = ccd_em_table[ccd_em_table.shape[0]-1,4]
-            Total_SOx_ccd = ccd_em_table[ccd_em_table.shape[0]-1,5]
-            Total_H2O_ccd = ccd_em_table[ccd_em_table.shape[0]-1,6]
-            Total_CO_ccd = ccd_em_table[ccd_em_table.shape[0]-1,7]
-            Total_HC_ccd = ccd_em_table[ccd_em_table.shape[0]-1,8]
-        else:
-            # Linear interpolation
-            diff_t = ccd_em_table[high_ind,1] - ccd_em_table[low_ind,1]
-            diff_Fuel = ccd_em_table[high_ind,2] - ccd_em_table[low_ind,2]
-            diff_CO2 = ccd_em_table[high_ind,3] - ccd_em_table[low_ind,3]
-            diff_NOx = ccd_em_table[high_ind,4] - ccd_em_table[low_ind,4]
-            diff_SOx = ccd_em_table[high_ind,5] - ccd_em_table[low_ind,5]
-            diff_H2O = ccd_em_table[high_ind,6] - ccd_em_table[low_ind,6]
-            diff_CO = ccd_em_table[high_ind,7] - ccd_em_table[low_ind,7]
-            diff_HC = ccd_em_table[high_ind,8] - ccd_em_table[low_ind,8]
-
-            timeDiff = timeCCD - ccd_em_table[low_ind,1]
-            Total_Fuel_ccd = (diff_Fuel/diff_t)*timeDiff + ccd_em_table[low_ind,2]
-            Total_CO2_ccd = (diff_CO2/diff_t)*timeDiff + ccd_em_table[low_ind,3]
-            Total_NOx_ccd = (diff_NOx/diff_t)*timeDiff + ccd_em_table[low_ind,4]
-            Total_SOx_ccd = (diff_SOx/diff_t)*timeDiff + ccd_em_table[low_ind,5]
-            Total_H2O_ccd = (diff_H2O/diff_t)*timeDiff + ccd_em_table[low_ind,6]
-            Total_CO_ccd = (diff_CO/diff_t)*timeDiff + ccd_em_table[low_ind,7]
-            Total_HC_ccd = (diff_HC/diff_t)*timeDiff + ccd_em_table[low_ind,8] 
+        # is a simple interpolation calculation within the interval the ccd time
+        # falls into, clamped to the first and last entries of the table
+        Total_Fuel_ccd, Total_CO2_ccd, Total_NOx_ccd, Total_SOx_ccd, Total_H2O_ccd, Total_CO_ccd, Total_HC_ccd = interpolateCCD(ccdIndex[airplane], np.atleast_1d(timeCCD))[0]
 
         # And having done this, it is possible to compute the total carbon
         # equivalent emissions from all the types of gases combined. Recall from
@@ -214,170 +141,774 @@ def emissions_calc(FAAcode, airplane, timeTakeoff, timeClimb, timeApproach, time
 
     return Total_CO2, Total_CO2e, origin_em, origin_em_eq, destination_em, destination_em_eq, Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_CO2_lto, Total_CO2_ccd, Total_NOx_ccd, Total_SOx_ccd, Total_H2O_ccd, Total_CO_ccd, Total_HC_ccd
 
-def emissions_batch(onTime, ENGtableDict, LTOtableDict, CCDtable, backupDict, aircraftManufacture):
-    total_CO2s = []
-    total_CO2es = []
-    number_seats = []
-    total_Origin_LTO = []
-    total_Origin_LTOe = []
-    total_Destination_LTO = []
-    total_Destination_LTOe = []
-    airplane_manu_year = []
-    total_HC_lto = [] 
-    total_CO_lto = [] 
-    total_NOx_lto = [] 
-    total_CO2_lto = [] 
-    total_CO2_ccd = [] 
-    total_NOx_ccd = []
-    total_SOx_ccd = [] 
-    total_H2O_ccd = [] 
-    total_CO_ccd = [] 
-    total_HC_ccd = []
-
-    for ind, row in tqdm(onTime.iterrows(), total=onTime.shape[0]):
-        if row['Tail_Number'] in ENGtableDict and not pd.isna(row['AirTime']):
-            FAAcode = ENGtableDict[row['Tail_Number']]['FAA Engine Code']
-            airplane = ENGtableDict[row['Tail_Number']]['Standard Code']
-            ICAOcode = row['Reporting_Airline']
-            if row['Tail_Number'] in aircraftManufacture:
-                airplane_manu_year.append(aircraftManufacture[row['Tail_Number']])
-            else:
-                airplane_manu_year.append(np.nan)
-            timeTakeoff = 42
-            timeClimb = 132
-            timeApproach = 240
-            timeTaxiIn = 60 * row['TaxiIn']
-            timeTaxiOut = 60 * row['TaxiOut']
-            timeCCD = row['AirTime'] - ((timeTakeoff + timeClimb + timeApproach)/60)
-
-            Total_CO2, Total_CO2e, origin_em, origin_em_eq, destination_em, destination_em_eq, Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_CO2_lto, Total_CO2_ccd, Total_NOx_ccd, Total_SOx_ccd, Total_H2O_ccd, Total_CO_ccd, Total_HC_ccd = emissions_calc(FAAcode , airplane, timeTakeoff, timeClimb, timeApproach, timeTaxiIn, timeTaxiOut, timeCCD, LTOtableDict, CCDtable, backupDict)
-            total_CO2s.append(Total_CO2)
-            total_CO2es.append(Total_CO2e)
-            total_Origin_LTO.append(origin_em)
-            total_Origin_LTOe.append(origin_em_eq)
-            total_Destination_LTO.append(destination_em)
-            total_Destination_LTOe.append(destination_em_eq)
-            number_seats.append(ENGtableDict[row['Tail_Number']]['Number of Seats'])
-            total_HC_lto.append(Total_HC_lto)
-            total_CO_lto.append(Total_CO_lto)
-            total_NOx_lto.append(Total_NOx_lto)
-            total_CO2_lto.append(Total_CO2_lto)
-            total_CO2_ccd.append(Total_CO2_ccd)
-            total_NOx_ccd.append(Total_NOx_ccd)
-            total_SOx_ccd.append(Total_SOx_ccd)
-            total_H2O_ccd.append(Total_H2O_ccd)
-            total_CO_ccd.append(Total_CO_ccd)
-            total_HC_ccd.append(Total_HC_ccd)
+def emissions_vectorized(ltoRows, airplanes, TaxiIn, TaxiOut, AirTime, ltoRates, ccdIndex):
+    # Inputs:
+    # ltoRows: entry of ltoRates['Rates'] of each flight's engine (see
+    # resolveLTOrows), -1 if it has none
+    # airplanes: airplane type code of each flight
+    # TaxiIn, TaxiOut, AirTime: phase times of each flight, in minutes as
+    # reported in the On-Time dataset
+    # ltoRates: per-engine LTO emission rates, as built by compileLTOrates
+    # ccdIndex: CCD emissions data per airplane type, as built by compileCCDtable
+
+    # Outputs:
+    # flights x 16 array, with the same columns as the outputs of emissions_calc
+
+    # This is the columnar equivalent of calling emissions_calc once per flight
+    # with the standard LTO times: every quantity below is computed for all
+    # flights at once, and agrees with the per-flight path to within
+    # floating-point tolerance.
+
+    # Carbon Equivalent Conversion Factors
+    CO_2_CO2 = 1.57
+    HC_2_CO2 = 84
+    NOx_2_CO2 = 298
+
+    timeTakeoff, timeClimb, timeApproach = TIME_TAKEOFF, TIME_CLIMB, TIME_APPROACH
+    timeTaxiIn = 60 * np.asarray(TaxiIn, dtype=float)
+    timeTaxiOut = 60 * np.asarray(TaxiOut, dtype=float)
+    timeCCD = np.asarray(AirTime, dtype=float) - ((timeTakeoff + timeClimb + timeApproach)/60)
+    nFlights = len(ltoRows)
+
+    ###########################################################################
+    # LTO Cycle Emissions Calculations                                        #
+    ###########################################################################
+    with metrics.stage('LTO emissions'):
+        hasLTO = ltoRows >= 0
+
+        # Rates are arranged as (species, phase), with species HC, CO, NOx, Fuel,
+        # CO2 and phases take-off, climb, approach and idle. Flights without any
+        # engine match pick up the trailing row of zeros.
+        rates = ltoRates['Rates'][ltoRows]
+        taxiIn = np.where(hasLTO, timeTaxiIn, 0)
+        taxiOut = np.where(hasLTO, timeTaxiOut, 0)
+        zeros = np.zeros(nFlights)
+        phaseTimes = np.column_stack([zeros + timeTakeoff, zeros + timeClimb, zeros + timeApproach, taxiIn + taxiOut])
+        originTimes = np.column_stack([zeros + timeTakeoff, zeros + timeClimb, zeros, taxiOut])
+        destinationTimes = np.column_stack([zeros, zeros, zeros + timeApproach, taxiIn])
+
+        lto = np.einsum('nsp,np->ns', rates, phaseTimes)
+        origin = np.einsum('nsp,np->ns', rates, originTimes)
+        destination = np.einsum('nsp,np->ns', rates, destinationTimes)
+
+        # Weights converting each species into CO2 equivalent (fuel does not count)
+        equivalent = np.array([HC_2_CO2, CO_2_CO2, NOx_2_CO2, 0, 1])
+        Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_CO2_lto = lto[:,0], lto[:,1], lto[:,2], lto[:,4]
+        Total_CO2e_lto = lto @ equivalent
+        origin_em, destination_em = origin[:,4], destination[:,4]
+        origin_em_eq, destination_em_eq = origin @ equivalent, destination @ equivalent
+    ###########################################################################
+
+
+    ###########################################################################
+    # CCD Cycle Emissions Calculations                                        #
+    ###########################################################################
+    with metrics.stage('CCD interpolation'):
+        # Columns: CO2, NOx, SOx, H2O, CO, HC
+        ccd = np.zeros((nFlights, 6))
+        hasCCD = np.zeros(nFlights, dtype=bool)
+        # Interpolating all flights of the same airplane type at once
+        for airplane, flights in pd.Series(airplanes).groupby(airplanes).indices.items():
+            if airplane in ccdIndex:
+                hasCCD[flights] = True
+                ccd[flights] = interpolateCCD(ccdIndex[airplane], timeCCD[flights])[:,1:]
+
+    Total_CO2_ccd, Total_NOx_ccd, Total_SOx_ccd, Total_H2O_ccd, Total_CO_ccd, Total_HC_ccd = ccd.T
+    Total_CO2e_ccd = HC_2_CO2*Total_HC_ccd + CO_2_CO2*Total_CO_ccd + NOx_2_CO2*Total_NOx_ccd + Total_CO2_ccd
+
+    # As in emissions_calc, an airplane type without CCD data also reports
+    # zero for the per-species LTO totals (but keeps its LTO CO2e and its
+    # origin/destination emissions)
+    Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_CO2_lto = (np.where(hasCCD, x, 0) for x in (Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_CO2_lto))
+    ###########################################################################
+
+    ###########################################################################
+    # Overall Engine Emissions                                                #
+    ###########################################################################
+    Total_CO2 = Total_CO2_lto + Total_CO2_ccd
+    Total_CO2e = Total_CO2e_lto + Total_CO2e_ccd
+
+    return np.column_stack([Total_CO2, Total_CO2e, origin_em, origin_em_eq, destination_em, destination_em_eq, Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_CO2_lto, Total_CO2_ccd, Total_NOx_ccd, Total_SOx_ccd, Total_H2O_ccd, Total_CO_ccd, Total_HC_ccd])
+
+def resolveLTOrows(ltoRates, FAAcodes, airplanes):
+    # Entry of ltoRates['Rates'] of each engine, falling back to the LTO Backup
+    # engine for the airplane type when the FAA code doesn't match, and -1 when
+    # neither does
+    ltoRows = pd.Series(FAAcodes).map(ltoRates['Row'])
+    unmatched = ltoRows.isna()
+    ltoRows = ltoRows.fillna(pd.Series(airplanes).map(ltoRates['Backup Row']))
+    metrics.count('LTO backup used', (unmatched & ltoRows.notna()).sum())
+    metrics.count('no engine match', ltoRows.isna().sum())
+    return ltoRows.fillna(-1).to_numpy(dtype=int)
+
+def flight_emissions(FAAcode, airplane, TaxiIn, TaxiOut, AirTime, ltoRates, ccdIndex, cache=None):
+    # Inputs:
+    # FAAcode: FAA engine code
+    # airplane: airplane type code
+    # TaxiIn, TaxiOut, AirTime: phase times of the flight, in minutes as
+    # reported in the On-Time dataset
+    # ltoRates, ccdIndex: see emissions_calc
+    # cache: optional EmissionsCache shared with other calls
+
+    # Outputs:
+    # Same as emissions_calc, for the standard take-off, climb and approach times
+    timeCCD = AirTime - ((TIME_TAKEOFF + TIME_CLIMB + TIME_APPROACH)/60)
+    if cache is None or pd.isna(TaxiIn) or pd.isna(TaxiOut) or pd.isna(AirTime):
+        return emissions_calc(FAAcode, airplane, TIME_TAKEOFF, TIME_CLIMB, TIME_APPROACH, 60*TaxiIn, 60*TaxiOut, timeCCD, ltoRates, ccdIndex)
+
+    key = (ltoRates['Row'].get(FAAcode, ltoRates['Backup Row'].get(airplane, -1)), airplane, TaxiIn, TaxiOut, AirTime)
+    results = cache.get(key)
+    if results is None:
+        results = np.array(emissions_calc(FAAcode, airplane, TIME_TAKEOFF, TIME_CLIMB, TIME_APPROACH, 60*TaxiIn, 60*TaxiOut, timeCCD, ltoRates, ccdIndex), dtype=float)
+        cache.put(key, results)
+    return tuple(results)
+
+class EmissionsCache:
+    # Bounded, least-recently-used memo of flight_emissions results, keyed on
+    # the resolved engine (entry of ltoRates['Rates']), the airplane type and
+    # the TaxiIn, TaxiOut and AirTime minutes of a flight. It pays off for
+    # repeated single-flight estimates (e.g. the estimate service), where a
+    # hit skips a scalar emissions_calc. It is not used by emissions_batch: a
+    # Python lookup per distinct key costs more than the vectorized kernel it
+    # would skip (500k flights: 1.0 s uncached, 4.9 s with a cold cache,
+    # 3.9 s with a warm one).
+    def __init__(self, maxsize=1000000):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        results = self.entries.get(key)
+        if results is None:
+            self.misses += 1
         else:
-            total_CO2s.append(np.nan)
-            total_CO2es.append(np.nan)
-            number_seats.append(np.nan)
-            total_Origin_LTO.append(np.nan)
-            total_Origin_LTOe.append(np.nan)
-            total_Destination_LTO.append(np.nan)
-            total_Destination_LTOe.append(np.nan)
-            airplane_manu_year.append(np.nan)
-            total_HC_lto.append(np.nan)
-            total_CO_lto.append(np.nan)
-            total_NOx_lto.append(np.nan)
-            total_CO2_lto.append(np.nan)
-            total_CO2_ccd.append(np.nan)
-            total_NOx_ccd.append(np.nan)
-            total_SOx_ccd.append(np.nan)
-            total_H2O_ccd.append(np.nan)
-            total_CO_ccd.append(np.nan)
-            total_HC_ccd.append(np.nan)
-    
-    onTime['Total CO2'] = total_CO2s
-    onTime['Total CO2E'] = total_CO2es
-    onTime['Number Seats'] = number_seats
-    onTime['Origin LTO CO2'] =  total_Origin_LTO
-    onTime['Origin LTO CO2e'] = total_Origin_LTOe
-    onTime['Destination LTO CO2'] = total_Destination_LTO
-    onTime['Destination LTO CO2e'] = total_Destination_LTOe
-    onTime['Airplane Manu Year'] = airplane_manu_year
-    onTime['Total_HC_lto'] =  total_HC_lto
-    onTime['Total_CO_lto'] = total_CO_lto
-    onTime['Total_NOx_lto'] = total_NOx_lto
-    onTime['Total_CO2_lto'] = total_CO2_lto
-    onTime['Total_CO2_ccd'] =  total_CO2_ccd
-    onTime['Total_NOx_ccd'] = total_NOx_ccd
-    onTime['Total_SOx_ccd'] = total_SOx_ccd
-    onTime['Total_H2O_ccd'] = total_H2O_ccd
-    onTime['Total_CO_ccd'] = total_CO_ccd
-    onTime['Total_HC_ccd'] = total_HC_ccd
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return results
+
+    def put(self, key, results):
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize,
+                'hit rate': self.hits / lookups if lookups else 0.0}
+
+def emissions_batch(onTime, fleet, ltoRates, ccdIndex):
+    # Inputs:
+    # onTime: On-Time Reporting DataFrame, one row per flight
+    # fleet: FleetTable of registered tail numbers
+    # ltoRates: per-engine LTO emission rates, as built by compileLTOrates
+    # ccdIndex: CCD emissions data per airplane type, as built by compileCCDtable
+
+    # Outputs:
+    # onTime, with the 18 emissions columns appended. Flights whose tail
+    # number is not registered or whose AirTime is missing are left as NaN.
+
+    ###########################################################################
+    # Tail Number -> Engine -> Airplane Type                                  #
+    ###########################################################################
+    # The whole column of tail numbers is looked up at once; flights then pick
+    # up the fleet arrays' entries of their tail number
+    with metrics.stage('LTO lookup'):
+        tailIDs = fleet.lookup(onTime['Tail_Number'])
+        valid = (tailIDs >= 0) & onTime['AirTime'].notna().to_numpy()
+        flightIDs = tailIDs[valid]
+
+        FAAcodes = fleet.engines[flightIDs].astype(np.int64)
+        airplanes = fleet.types[flightIDs].astype(np.int64)
+        seats = fleet.seats[flightIDs].astype(float)
+        manuYears = fleet.years[flightIDs].astype(float)
+        ltoRows = resolveLTOrows(ltoRates, FAAcodes, airplanes)
+
+    minutes = np.column_stack([onTime[column].to_numpy(dtype=float)[valid] for column in ['TaxiIn', 'TaxiOut', 'AirTime']])
+
+    # Data coverage of the batch
+    metrics.count('flights', len(onTime))
+    metrics.count('flights calculated', valid.sum())
+    metrics.count('no tail match', (tailIDs < 0).sum())
+    metrics.count('missing AirTime', onTime['AirTime'].isna().sum())
+    metrics.count('no CCD type', (~np.isin(airplanes, list(ccdIndex))).sum())
+
+    ###########################################################################
+    # Emissions Calculations                                                  #
+    ###########################################################################
+    results = emissions_vectorized(ltoRows, airplanes, minutes[:,0], minutes[:,1], minutes[:,2], ltoRates, ccdIndex)
+
+    Total_CO2, Total_CO2e, origin_em, origin_em_eq, destination_em, destination_em_eq, Total_HC_lto, Total_CO_lto, Total_NOx_lto, Total_CO2_lto, Total_CO2_ccd, Total_NOx_ccd, Total_SOx_ccd, Total_H2O_ccd, Total_CO_ccd, Total_HC_ccd = results.T
+
+    def scatter(values):
+        # Places per-flight results back into a full-length column
+        column = np.full(onTime.shape[0], np.nan)
+        column[valid] = values
+        return column
+
+    onTime['Total CO2'] = scatter(Total_CO2)
+    onTime['Total CO2E'] = scatter(Total_CO2e)
+    onTime['Number Seats'] = scatter(seats)
+    onTime['Origin LTO CO2'] =  scatter(origin_em)
+    onTime['Origin LTO CO2e'] = scatter(origin_em_eq)
+    onTime['Destination LTO CO2'] = scatter(destination_em)
+    onTime['Destination LTO CO2e'] = scatter(destination_em_eq)
+    onTime['Airplane Manu Year'] = scatter(manuYears)
+    onTime['Total_HC_lto'] =  scatter(Total_HC_lto)
+    onTime['Total_CO_lto'] = scatter(Total_CO_lto)
+    onTime['Total_NOx_lto'] = scatter(Total_NOx_lto)
+    onTime['Total_CO2_lto'] = scatter(Total_CO2_lto)
+    onTime['Total_CO2_ccd'] =  scatter(Total_CO2_ccd)
+    onTime['Total_NOx_ccd'] = scatter(Total_NOx_ccd)
+    onTime['Total_SOx_ccd'] = scatter(Total_SOx_ccd)
+    onTime['Total_H2O_ccd'] = scatter(Total_H2O_ccd)
+    onTime['Total_CO_ccd'] = scatter(Total_CO_ccd)
+    onTime['Total_HC_ccd'] = scatter(Total_HC_ccd)
     return onTime
 
-def readReferenceTables(onTime):
+def compileLTOrates(LTOtable, backup):
+    # Inputs:
+    # LTOtable: ICAO Emissions Databank
+    # backup: LTO Backup table, mapping each airplane type to a back-up FAA
+    # engine code
+
+    # Outputs:
+    # Dictionary with
+    # 'Rates': (engines + 1) x 5 x 4 array of LTO rates, with species HC, CO,
+    # NOx, Fuel, CO2 and phases take-off, climb, approach, idle. The last
+    # entry is all zeros, for flights without any engine match
+    # 'Row': FAA engine code -> entry of 'Rates'
+    # 'Backup Row': airplane type -> entry of 'Rates' of its back-up engine
+
+    # Average value of the emissions for each FAA code (for the case where
+    # multiple engines correspond to the same FAA code), with any missing rate
+    # counted as 0
+    averaged = LTOtable[LTO_RATE_COLUMNS].fillna(0).groupby(LTOtable['FAA Code']).mean()
+    rows = {code: i for i, code in enumerate(averaged.index)}
+
+    # Back-up engines are only useful if they appear in the databank themselves
+    backupRows = {}
+    for airplane, code in zip(backup['Standard Code'], backup['FAA Engine Code']):
+        if code in rows:
+            backupRows[airplane] = rows[code]
+
+    rates = np.vstack([averaged.to_numpy(), np.zeros((1, len(LTO_RATE_COLUMNS)))]).reshape(-1, 5, 4)
+    return {'Rates': rates, 'Row': rows, 'Backup Row': backupRows}
+
+def compileCCDtable(CCDtable):
+    # Inputs:
+    # CCDtable: Engine Fuel Consumption table
+
+    # Outputs:
+    # Dictionary mapping airplane type -> (durations, emissions), where
+    # durations are the table's flight durations in minutes, sorted in
+    # increasing order, and emissions the matching Fuel Burnt, CO2, NOx, SOx,
+    # H2O, CO and HC columns (kg)
+    ccdIndex = {}
+    for airplane, CCDairplanes in CCDtable.groupby('Standard Code'):
+        ccd_em_table = CCDairplanes.sort_values('Duration (min)', kind='stable')[CCD_COLUMNS].fillna(0).to_numpy()
+        ccdIndex[airplane] = (ccd_em_table[:,1].copy(), ccd_em_table[:,2:].copy())
+    return ccdIndex
+
+def interpolateCCD(ccdEntry, timeCCD):
+    # Inputs:
+    # ccdEntry: (durations, emissions) of one airplane type from compileCCDtable
+    # timeCCD: array of times during cruising, in minutes
+
+    # Outputs:
+    # len(timeCCD) x 7 array of Fuel Burnt, CO2, NOx, SOx, H2O, CO and HC (kg),
+    # linearly interpolated between the table entries. Times before the first
+    # or after the last entry take that entry's values.
+    durations, emissions = ccdEntry
+    return np.column_stack([np.interp(timeCCD, durations, emissions[:,j]) for j in range(emissions.shape[1])])
+
+# Standard Code of the tails whose type is blank in the Master Airplane Engine
+# Table: no LTO Backup engine nor CCD data matches it
+NO_TYPE = -1
+
+class FleetTable:
+    # Registered aircraft, held in typed arrays rather than one dict per tail
+    # number. Tail numbers are interned to integer IDs: a tail's ID is its
+    # position in the sorted tails array, and indexes every other array.
+    # Inputs:
+    # tails: sorted, unique tail numbers
+    # types: Standard Code of each tail (NO_TYPE if blank)
+    # seats: number of seats of each tail (NaN if blank)
+    # engines: FAA engine code of each tail
+    # years: manufacture year of each tail (NaN if unknown)
+
+    # The arrays can be memory-mapped from the reference-table cache, in which
+    # case every process reading them shares the same pages.
+    def __init__(self, tails, types, seats, engines, years):
+        self.tails = tails
+        self.types = types
+        self.seats = seats
+        self.engines = engines
+        self.years = years
+
+    def __len__(self):
+        return len(self.tails)
+
+    def lookup(self, tails):
+        # IDs of a whole column of tail numbers at once, -1 for those that
+        # aren't registered. Each distinct tail number is searched for once.
+        tailCodes, uniqueTails = pd.factorize(np.asarray(tails, dtype=object))
+        uniqueTails = np.asarray(uniqueTails, dtype=str)
+        ids = np.full(len(uniqueTails) + 1, -1)
+        if len(self.tails):
+            positions = np.searchsorted(self.tails, uniqueTails).clip(max=len(self.tails) - 1)
+            ids[:-1] = np.where(self.tails[positions] == uniqueTails, positions, -1)
+        return ids[tailCodes]
+
+    def find(self, tail):
+        # ID of a single tail number, -1 if it isn't registered
+        return int(self.lookup([tail])[0])
+
+    def entry(self, ID):
+        # Attributes of one tail, by ID, with None for blank ones
+        return {'Standard Code': None if self.types[ID] == NO_TYPE else int(self.types[ID]),
+                'Number of Seats': None if np.isnan(self.seats[ID]) else int(self.seats[ID]),
+                'FAA Engine Code': int(self.engines[ID]), 'Manufacture Year': float(self.years[ID])}
+
+def compileFleetTable(ENGtable, aircraft):
+    # Inputs:
+    # ENGtable: Master Airplane Engine Table, rows without an FAA engine code
+    # removed
+    # aircraft: Aircraft By Airline table, latest reported year only
+
+    # Outputs:
+    # FleetTable of the tails in ENGtable. The last row of a tail number
+    # repeated in either table is the one kept. Blank types become NO_TYPE
+    # and blank seat counts NaN, rather than a wrapped-around integer.
+    ENGtable = ENGtable.assign(**{'Tail Number': ENGtable['Tail Number'].astype(str)})
+    ENGtable = ENGtable.drop_duplicates('Tail Number', keep='last').sort_values('Tail Number')
+    years = pd.Series(aircraft['MANUFACTURE_YEAR'].to_numpy(dtype=float), index=aircraft['TAIL_NUMBER'].astype(str))
+    years = years[~years.index.duplicated(keep='last')]
+    tails = ENGtable['Tail Number'].to_numpy(dtype=str)
+    return FleetTable(tails,
+                      ENGtable['Standard Code'].fillna(NO_TYPE).to_numpy(dtype=np.int32),
+                      ENGtable['Number of Seats'].to_numpy(dtype=np.float32),
+                      ENGtable['FAA Engine Code (Complete)'].to_numpy(dtype=np.int32),
+                      years.reindex(tails).to_numpy(dtype=np.float32))
+
+def compileReferenceTables():
     # Downloads Aircraft Information
     aircraft = pd.read_csv('ReferenceTables/Aircraft By Airline.csv')
     # Keeps latest reported aircraft
     aircraft = aircraft[aircraft['YEAR'] == 2020]
 
-    # Saves as dictionary for quick look-up
-    aircraftManufacture = {}
-    for i,row in aircraft.iterrows():
-        aircraftManufacture[row['TAIL_NUMBER']] = row['MANUFACTURE_YEAR']
+    # Loads in LTO emission information
+    LTOtable = pd.read_excel('ReferenceTables/ICAO Emissions Databank.xlsx')
 
-    # Loads in LTO emission information and saves into a dictionary
-    LTOtable = pd.read_excel('ReferenceTables/ICAO Emissions Databank.xlsx').set_index('UID No')
-    LTOtableDict = LTOtable.to_dict()
-
-    # Loads in CCD emission information
+    # Loads in CCD emission information, grouped by airplane type
     CCDtable = pd.read_excel('ReferenceTables/Engine Fuel Consumption.xlsx')
+    ccdIndex = compileCCDtable(CCDtable)
 
-    # Loads in Engine Table
+    # Loads in Engine Table, keeping the newest entry of each Tail Number
+    # together with its manufacture year
     ENGtable = pd.read_excel('ReferenceTables/Master Airplane Engine Table.xlsx')
-    ENGtableDict = {}
-    # Maps newest Tail Number to {Standard Code, Number of Seats, FAA Engine Code} 
-    for i, row in ENGtable.iterrows():
-        if not pd.isna(row['FAA Engine Code (Complete)']):
-            ENGtableDict[row['Tail Number']] = {'Standard Code': row['Standard Code'],
-                                            'Number of Seats': row['Number of Seats'],
-                                            'FAA Engine Code': int(row['FAA Engine Code (Complete)'])}
+    ENGtable = ENGtable[ENGtable['FAA Engine Code (Complete)'].notna()]
+    fleet = compileFleetTable(ENGtable, aircraft)
 
     # Loads in LTO Backup information for Ambiguous Flights
     backup = pd.read_excel('ReferenceTables/LTO Backup.xlsx')
-    backupDict = backup.set_index('Standard Code').to_dict()
 
-    return aircraftManufacture, LTOtableDict, CCDtable, ENGtableDict, backupDict
+    # Compiles the per-engine LTO rates once, for all flights
+    ltoRates = compileLTOrates(LTOtable, backup)
+
+    return fleet, ltoRates, ccdIndex
+
+def referenceTablesKey():
+    # Hash of the contents of every reference table (and of the cache layout),
+    # so that the compiled tables are rebuilt whenever any of them changes
+    digest = hashlib.sha256(str(CACHE_VERSION).encode())
+    for name in REFERENCE_TABLES:
+        digest.update(name.encode())
+        with open(os.path.join('ReferenceTables', name), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def packReferenceTables(fleet, ltoRates, ccdIndex):
+    # Flattens the compiled reference tables into plain typed arrays
+    ccdTypes = list(ccdIndex)
+    return {'fleet_tails': fleet.tails,
+            'fleet_types': fleet.types,
+            'fleet_seats': fleet.seats,
+            'fleet_engines': fleet.engines,
+            'fleet_years': fleet.years,
+            'lto_rates': ltoRates['Rates'],
+            'lto_codes': np.array(list(ltoRates['Row']), dtype=np.int64),
+            'lto_backup_types': np.array(list(ltoRates['Backup Row']), dtype=np.int64),
+            'lto_backup_rows': np.array(list(ltoRates['Backup Row'].values()), dtype=np.int64),
+            'ccd_types': np.array(ccdTypes, dtype=np.int64),
+            'ccd_offsets': np.cumsum([0] + [len(ccdIndex[a][0]) for a in ccdTypes]),
+            'ccd_durations': np.concatenate([ccdIndex[a][0] for a in ccdTypes]),
+            'ccd_emissions': np.concatenate([ccdIndex[a][1] for a in ccdTypes])}
+
+def unpackReferenceTables(arrays):
+    # Inverse of packReferenceTables. The fleet keeps the arrays as they are,
+    # so that memory-mapped arrays aren't copied.
+    if 'eng_tails' in arrays:
+        # Layout of CACHE_VERSION 1, found in older snapshots (see
+        # UpdateEmissions.py)
+        ENGtable = pd.DataFrame({'Tail Number': arrays['eng_tails'], 'Standard Code': arrays['eng_types'],
+                                 'Number of Seats': arrays['eng_seats'], 'FAA Engine Code (Complete)': arrays['eng_codes']})
+        fleet = compileFleetTable(ENGtable, pd.DataFrame({'TAIL_NUMBER': arrays['manu_tails'], 'MANUFACTURE_YEAR': arrays['manu_years']}))
+    else:
+        fleet = FleetTable(arrays['fleet_tails'], arrays['fleet_types'], arrays['fleet_seats'], arrays['fleet_engines'], arrays['fleet_years'])
+    ltoRates = {'Rates': np.asarray(arrays['lto_rates']),
+                'Row': {code: i for i, code in enumerate(arrays['lto_codes'].tolist())},
+                'Backup Row': dict(zip(arrays['lto_backup_types'].tolist(), arrays['lto_backup_rows'].tolist()))}
+    offsets = arrays['ccd_offsets'].tolist()
+    ccdIndex = {}
+    for i, airplane in enumerate(arrays['ccd_types'].tolist()):
+        ccdIndex[airplane] = (arrays['ccd_durations'][offsets[i]:offsets[i+1]], arrays['ccd_emissions'][offsets[i]:offsets[i+1]])
+    return fleet, ltoRates, ccdIndex
+
+def readReferenceTables(onTime, rebuildCache=False):
+    # Loads the compiled reference tables from ReferenceTables/.cache, one
+    # memory-mappable .npy file per array, compiling them from the source
+    # workbooks first if they changed since the cache was written (or if
+    # rebuildCache is set)
+    key = referenceTablesKey()
+    cacheLoc = os.path.join(CACHE_DIR, key)
+    if not rebuildCache and os.path.isdir(cacheLoc):
+        try:
+            arrays = {name[:-4]: np.load(os.path.join(cacheLoc, name), mmap_mode='r') for name in os.listdir(cacheLoc)}
+            return unpackReferenceTables(arrays)
+        except (OSError, ValueError, KeyError):
+            # Another process swapped the cache out while it was being read,
+            # or it is damaged (e.g. a truncated or overwritten .npy file, or
+            # a missing one); it is rebuilt and replaced
+            rebuildCache = True
+
+    tables = compileReferenceTables()
+    metrics.count('reference tables compiled')
+
+    # Writes the new cache next to the old ones and swaps it in, so that a
+    # concurrent reader never sees a partially written cache. A cache being
+    # rebuilt is moved aside first, as only an empty directory can be
+    # replaced; processes that already mapped its files keep them.
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmpLoc = f'{cacheLoc}.{os.getpid()}.tmp'
+    oldLoc = f'{cacheLoc}.{os.getpid()}.old'
+    os.makedirs(tmpLoc, exist_ok=True)
+    for name, array in packReferenceTables(*tables).items():
+        np.save(os.path.join(tmpLoc, name + '.npy'), array)
+    if rebuildCache and os.path.isdir(cacheLoc):
+        try:
+            os.replace(cacheLoc, oldLoc)
+        except OSError:
+            pass
+    try:
+        os.replace(tmpLoc, cacheLoc)
+    except OSError:
+        # Another process compiled the same tables first
+        pass
+    shutil.rmtree(tmpLoc, ignore_errors=True)
+    shutil.rmtree(oldLoc, ignore_errors=True)
+
+    # Removes the caches of earlier reference tables. Caches written after
+    # this one (the tables changed again meanwhile) and caches still being
+    # written are left alone.
+    current = os.path.getmtime(cacheLoc)
+    for name in os.listdir(CACHE_DIR):
+        location = os.path.join(CACHE_DIR, name)
+        try:
+            if name != key and not name.endswith('.tmp') and os.path.getmtime(location) < current:
+                shutil.rmtree(location, ignore_errors=True)
+        except OSError:
+            # Removed by another process in the meantime
+            pass
+    return tables
     
+def tablesDigest(arrays):
+    # Hash of packed reference tables, identifying the exact tables a month
+    # was calculated with
+    digest = hashlib.sha256()
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        digest.update(f'{name}:{array.dtype.str}:{array.shape}'.encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+def tablesSnapshotLocation(digest):
+    return f'{DEPENDENCIES_DIR}/Tables/{digest}'
+
+def snapshotReferenceTables(tables):
+    # Saves a snapshot of the compiled reference tables (unless there is one
+    # already), returning its digest
+    arrays = packReferenceTables(*tables)
+    digest = tablesDigest(arrays)
+    snapshotLoc = tablesSnapshotLocation(digest)
+    if not os.path.isdir(snapshotLoc):
+        tmpLoc = f'{snapshotLoc}.{os.getpid()}.tmp'
+        os.makedirs(tmpLoc, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmpLoc, name + '.npy'), array)
+        try:
+            os.replace(tmpLoc, snapshotLoc)
+        except OSError:
+            # Another worker saved the same snapshot first
+            shutil.rmtree(tmpLoc, ignore_errors=True)
+    return digest
+
+def loadTablesSnapshot(digest):
+    # Reference tables of a snapshot, or None if it doesn't exist
+    snapshotLoc = tablesSnapshotLocation(digest)
+    if not os.path.isdir(snapshotLoc):
+        return None
+    return unpackReferenceTables({name[:-4]: np.load(os.path.join(snapshotLoc, name)) for name in os.listdir(snapshotLoc)})
+
+def dependenciesLocation(resultsLoc):
+    # What a results file depends on is recorded under a hidden name next to
+    # it, which dataset readers skip. A month saved in several formats has a
+    # record per format, as each file is updated on its own.
+    directory, name = os.path.split(resultsLoc)
+    return os.path.join(directory, f'.{name}.dependencies.json')
+
+def loadDependencies(resultsLoc):
+    # Dependencies recorded for a results file, or None if there are none
+    try:
+        with open(dependenciesLocation(resultsLoc)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def recordDependencies(resultsLoc, tails, tables):
+    # Inputs:
+    # resultsLoc: results file just saved
+    # tails: tail numbers of its flights
+    # tables: reference tables its emissions were calculated with
+
+    # Saves the digest of the reference tables (keeping a snapshot of them)
+    # and the tail numbers, FAA engine codes and Standard Codes the results
+    # depend on, so that UpdateEmissions.py can later tell whether a
+    # change in the reference tables affects them
+    fleet, ltoRates, ccdIndex = tables
+    tails = sorted({tail for tail in tails if isinstance(tail, str)})
+    tailIDs = fleet.lookup(tails)
+    tailIDs = tailIDs[tailIDs >= 0]
+    dependencies = {'reference tables': snapshotReferenceTables(tables),
+                    'tail numbers': tails,
+                    'engine codes': np.unique(fleet.engines[tailIDs]).tolist(),
+                    'standard codes': np.setdiff1d(fleet.types[tailIDs], [NO_TYPE]).tolist()}
+    saveLoc = dependenciesLocation(resultsLoc)
+    with open(saveLoc + '.partial', 'w') as f:
+        json.dump(dependencies, f)
+    os.replace(saveLoc + '.partial', saveLoc)
+    return dependencies
+
+def emissions_stream(onTimeLoc, writer, tables, chunksize):
+    # Inputs:
+    # onTimeLoc: location (or open file) of the On-Time CSV
+    # writer: EmissionsWriter the results are written to
+    # tables: reference tables, as returned by readReferenceTables
+    # chunksize: number of flights processed at a time
+
+    # Outputs:
+    # Set of the tail numbers streamed
+
+    # Only ONTIME_COLUMNS are read, chunksize rows at a time, and each chunk's
+    # emissions are written out as soon as they are computed, so that memory
+    # use does not grow with the size of the input
+    fleet, ltoRates, ccdIndex = tables
+    tails = set()
+    reader = iter(pd.read_csv(onTimeLoc, usecols=ONTIME_COLUMNS, dtype=ONTIME_DTYPES, chunksize=chunksize))
+    while True:
+        with metrics.stage('CSV parse'):
+            chunk = next(reader, None)
+        if chunk is None:
+            break
+        tails.update(chunk['Tail_Number'].dropna().unique())
+        writer.write(emissions_batch(chunk, fleet, ltoRates, ccdIndex))
+    return tails
+
+def processMonth(YEAR, MONTH, tables, chunksize=None, baseUrl=BTS_URL, outputFormat='csv', keyColumnsOnly=False):
+    # Calculates the emissions of every flight in a month and saves them into
+    # the Results directory, in outputFormat (see SaveEmissions). Only the
+    # flight identifiers and emissions are kept with keyColumnsOnly or a
+    # chunksize; otherwise every column of the On-Time dataset is saved.
+
+    # Downloads On-Time Dataset into Reference Tables (unless already there),
+    # and reads it straight out of the zip
+    print(f'Loading in On-Time Dataset for {MONTH}, {YEAR}...')
+    zipLoc = downloadMonth(YEAR, MONTH, baseUrl=baseUrl)
+
+    saveLoc = resultsLocation(YEAR, MONTH, outputFormat)
+    os.makedirs(os.path.dirname(saveLoc), exist_ok=True)
+
+    # Results are written under a temporary name and only moved into place once
+    # complete, so that an interrupted run never leaves a month looking done
+    partialLoc = partialLocation(saveLoc)
+    columns = ONTIME_COLUMNS + EMISSIONS_COLUMNS if keyColumnsOnly or chunksize else None
+    with openOnTimeCSV(zipLoc) as onTimeFile, EmissionsWriter(partialLoc, outputFormat, columns) as writer:
+        if chunksize:
+            print(f'Streaming emissions calculations to {saveLoc}...')
+            tails = emissions_stream(onTimeFile, writer, tables, chunksize)
+        else:
+            print('Reading into Pandas Dataframe...')
+            with metrics.stage('CSV parse'):
+                if keyColumnsOnly:
+                    onTime = pd.read_csv(onTimeFile, usecols=ONTIME_COLUMNS, dtype=ONTIME_DTYPES)
+                else:
+                    onTime = pd.read_csv(onTimeFile, low_memory=False)
+
+            # Runs Emissions Batch Script
+            print('Beginning Emissions Calculations...')
+            fleet, ltoRates, ccdIndex = tables
+            onTimeEmissions = emissions_batch(onTime, fleet, ltoRates, ccdIndex)
+            print('Emissions Calculations Finished!')
+            tails = onTime['Tail_Number'].dropna().unique()
+
+            # Saves to Results directory
+            print(f'Saving to {saveLoc}')
+            writer.write(onTimeEmissions)
+    with metrics.stage('output write'):
+        os.replace(partialLoc, saveLoc)
+    recordDependencies(saveLoc, tails, tables)
+    return saveLoc
+
+def monthRange(start, end):
+    # All (YEAR, MONTH) pairs from start to end inclusive, both given as YYYY-MM
+    startYear, startMonth = (int(x) for x in start.split('-'))
+    endYear, endMonth = (int(x) for x in end.split('-'))
+    months = []
+    for index in range(startYear*12 + startMonth - 1, endYear*12 + endMonth):
+        months.append((index // 12, index % 12 + 1))
+    return months
+
+def metricsLocation(started):
+    return time.strftime('Results/Metrics/Metrics%Y%m%d-%H%M%S.json', time.localtime(started))
+
+def monthProfileLocation(profileLoc, YEAR, MONTH):
+    root, ext = os.path.splitext(profileLoc)
+    return f'{root}_{YEAR}_{MONTH}{ext}'
+
+# Reference tables and profiling options of a backfill worker process
+workerTables = None
+workerProfile = None
+workerTraceMemory = False
+
+def initBackfillWorker(profileLoc=None, traceMemory=False):
+    # Every worker maps the same cached reference tables, which the parent
+    # process has already compiled, instead of rebuilding its own copy.
+    # Metrics inherited from the parent process are cleared.
+    global workerTables, workerProfile, workerTraceMemory
+    metrics.reset()
+    with metrics.stage('reference-table ingest'):
+        workerTables = readReferenceTables(None)
+    workerProfile, workerTraceMemory = profileLoc, traceMemory
+
+def processMonthWorker(YEAR, MONTH, options):
+    # Returns the results location together with the metrics of the month
+    # (which, for a worker's first month, include its reference-table ingest)
+    try:
+        with profiled(workerProfile and monthProfileLocation(workerProfile, YEAR, MONTH), workerTraceMemory):
+            saveLoc = processMonth(YEAR, MONTH, workerTables, **options)
+        return saveLoc, metrics.report()
+    finally:
+        metrics.reset()
+
+def emissions_backfill(months, workers, connections=4, profileLoc=None, traceMemory=False, **options):
+    # Inputs:
+    # months: list of (YEAR, MONTH) pairs to calculate
+    # workers: number of months processed in parallel
+    # connections: number of months downloaded in parallel
+    # profileLoc: if given, each month is profiled with cProfile into
+    # profileLoc_<YEAR>_<MONTH>
+    # traceMemory: trace the memory of each month with tracemalloc
+    # options: keyword arguments of processMonth (chunksize, baseUrl, ...)
+
+    # Outputs:
+    # List of the (YEAR, MONTH) pairs that failed, and the metrics report of
+    # every month that succeeded, by YYYY-MM. Workers' metrics are also added
+    # into this process's metrics.
+
+    # Months whose results already exist are skipped, so that an interrupted
+    # backfill resumes where it stopped
+    outputFormat = options.get('outputFormat', 'csv')
+    todo = [(YEAR, MONTH) for YEAR, MONTH in months if not os.path.exists(resultsLocation(YEAR, MONTH, outputFormat))]
+    print(f'{len(months) - len(todo)} of {len(months)} months already done')
+
+    failed = []
+    reports = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initBackfillWorker, initargs=(profileLoc, traceMemory)) as pool:
+        # Months are downloaded concurrently, and each one is handed to a
+        # worker as soon as its download finishes
+        futures = {}
+        for (YEAR, MONTH), zipLoc in downloadMonths(todo, connections, options.get('baseUrl', BTS_URL)):
+            if isinstance(zipLoc, Exception):
+                print(f'Failed to download {MONTH}, {YEAR}: {zipLoc!r}')
+                failed.append((YEAR, MONTH))
+            else:
+                futures[pool.submit(processMonthWorker, YEAR, MONTH, options)] = (YEAR, MONTH)
+        for future in concurrent.futures.as_completed(futures):
+            YEAR, MONTH = futures[future]
+            try:
+                saveLoc, report = future.result()
+            except Exception as e:
+                print(f'Failed {MONTH}, {YEAR}: {e!r}')
+                failed.append((YEAR, MONTH))
+            else:
+                print(f'Finished {MONTH}, {YEAR}: {saveLoc}')
+                reports[f'{YEAR}-{MONTH:02d}'] = report
+                metrics.merge(report)
+    return sorted(failed), dict(sorted(reports.items()))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("Monthly Emissions Calculation")
-    parser.add_argument("YEAR", help="A year since 1987", type=int)
-    parser.add_argument("MONTH", help="A month as an integer 1-12", type=int)
+    parser.add_argument("YEAR", help="A year since 1987", type=int, nargs="?")
+    parser.add_argument("MONTH", help="A month as an integer 1-12", type=int, nargs="?")
+    parser.add_argument("--from", dest="start", help="First month of a backfill, as YYYY-MM")
+    parser.add_argument("--to", dest="end", help="Last month of a backfill, as YYYY-MM")
+    parser.add_argument("--workers", help="Number of months of a backfill processed in parallel", type=int, default=os.cpu_count())
+    parser.add_argument("--connections", help="Number of months of a backfill downloaded in parallel", type=int, default=4)
+    parser.add_argument("--bts-url", help="Base URL of the On-Time archives, e.g. a local mirror", default=BTS_URL)
+    parser.add_argument("--rebuild-cache", help="Recompile the reference tables even if they are cached", action="store_true")
+    parser.add_argument("--chunksize", help="Stream the On-Time dataset this many flights at a time, keeping only the columns needed", type=int)
+    parser.add_argument("--format", help="Output format; parquet and feather results are partitioned by year and month", choices=FORMATS, default='csv')
+    parser.add_argument("--key-columns", help="Only save the flight identifiers alongside the emissions", action="store_true")
+    parser.add_argument("--metrics", help="JSON file to save the run's stage timings and counters to (defaults to Results/Metrics/)")
+    parser.add_argument("--profile", help="Profile the run with cProfile and save the stats to this file (one file per month in a backfill)")
+    parser.add_argument("--tracemalloc", help="Trace memory allocations, reporting the peak and the top allocation sites", action="store_true")
     args = parser.parse_args()
-
-    # Make YEAR and MONTH be entered upon calling script
-    YEAR = args.YEAR    # Ex. 2021
-    MONTH = args.MONTH  # Integer 1-12, Ex. 11
-
-    # Downloads On-Time Dataset into Reference Tables
-    print(f'Loading in On-Time Dataset for {MONTH}, {YEAR}...')
-    url = f"https://transtats.bts.gov/PREZIP/On_Time_Reporting_Carrier_On_Time_Performance_1987_present_{YEAR}_{MONTH}.zip"
-    onTimeFilename = f"ReferenceTables/On_Time_{YEAR}_{MONTH}.zip"
-    r = requests.get(url, allow_redirects=True, verify=False)
-    open(onTimeFilename, 'wb').write(r.content)
-
-    # Unzips the On-Time Dataset and saves into a Pandas DataFrame
-    with zipfile.ZipFile(onTimeFilename, 'r') as zipRef:
-        zipRef.extractall('ReferenceTables')
-    print('Reading into Pandas Dataframe...')
-    onTime = pd.read_csv(f'ReferenceTables/On_Time_Reporting_Carrier_On_Time_Performance_(1987_present)_{YEAR}_{MONTH}.csv', low_memory=False)
-
-    # Reads in Reference Tables
-    print('Ingesting Reference Tables...')
-    aircraftManufacture, LTOtableDict, CCDtable, ENGtableDict, backupDict = readReferenceTables(onTime)
-
-    # Runs Emissions Batch Script
-    print('Beginning Emissions Calculations...')
-    onTimeEmissions = emissions_batch(onTime, ENGtableDict, LTOtableDict, CCDtable, backupDict, aircraftManufacture)
-
-    # Saves to Results directory
-    print('Emissions Calculations Finished!')
-    if not os.path.exists('Results'):
-        os.makedirs('Results')
-    saveLoc = f'Results/OnTimeEmissions{YEAR}_{MONTH}.csv'
-    print(f'Saving to {saveLoc}')
-    onTimeEmissions.to_csv(saveLoc)
-    print('Complete!')
\ No newline at end of file
+    if (args.YEAR is None) == (args.start is None) or (args.YEAR is None) != (args.MONTH is None) or (args.start is None) != (args.end is None):
+        parser.error("give either YEAR MONTH, or --from and --to")
+
+    started = time.time()
+    failed, reports = [], None
+    with profiled(args.profile, args.tracemalloc):
+        # Reads in Reference Tables
+        print('Ingesting Reference Tables...')
+        with metrics.stage('reference-table ingest'):
+            tables = readReferenceTables(None, rebuildCache=args.rebuild_cache)
+
+        options = {'chunksize': args.chunksize, 'baseUrl': args.bts_url, 'outputFormat': args.format, 'keyColumnsOnly': args.key_columns}
+        if args.start:
+            failed, reports = emissions_backfill(monthRange(args.start, args.end), args.workers, connections=args.connections,
+                                                 profileLoc=args.profile, traceMemory=args.tracemalloc, **options)
+        else:
+            # Make YEAR and MONTH be entered upon calling script
+            YEAR = args.YEAR    # Ex. 2021
+            MONTH = args.MONTH  # Integer 1-12, Ex. 11
+            processMonth(YEAR, MONTH, tables, **options)
+
+    # Stage timings are summed over every thread and worker process
+    report = {'command': sys.argv[1:], 'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+              'wall seconds': round(time.time() - started, 6), **metrics.report()}
+    if reports is not None:
+        report['failed'] = [f'{YEAR}-{MONTH:02d}' for YEAR, MONTH in failed]
+        report['months'] = reports
+    metricsLoc = args.metrics or metricsLocation(started)
+    saveReport(report, metricsLoc)
+    for name, stage in report['stages'].items():
+        print(f'{name:>24s}: {stage["seconds"]:.3f}s')
+    print(f'Metrics saved to {metricsLoc}')
+    if args.profile and not args.start:
+        printProfile(args.profile)
+    if failed:
+        sys.exit(f'{len(failed)} months failed: ' + ', '.join(f'{YEAR}-{MONTH:02d}' for YEAR, MONTH in failed))
+    print('Complete!')
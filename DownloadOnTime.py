@@ -0,0 +1,128 @@
+import io
+import os
+import zipfile
+import concurrent.futures
+import requests
+import urllib3
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from RunMetrics import metrics
+
+# Where BTS publishes the monthly On-Time Reporting Carrier On-Time
+# Performance archives
+BTS_URL = 'https://transtats.bts.gov/PREZIP'
+
+def onTimeURL(YEAR, MONTH, baseUrl=BTS_URL):
+    return f'{baseUrl}/On_Time_Reporting_Carrier_On_Time_Performance_1987_present_{YEAR}_{MONTH}.zip'
+
+def onTimeZipLocation(YEAR, MONTH, directory='ReferenceTables'):
+    return os.path.join(directory, f'On_Time_{YEAR}_{MONTH}.zip')
+
+def makeSession(connections=4):
+    # Session whose connection pool holds at most `connections` connections,
+    # shared by every download made through it
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=connections, pool_maxsize=connections, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def remoteSize(session, url):
+    # Size of the remote file in bytes, or None if the server doesn't say
+    try:
+        r = session.head(url, allow_redirects=True, verify=False, timeout=60)
+    except requests.RequestException:
+        return None
+    if r.status_code != 200 or 'Content-Length' not in r.headers:
+        return None
+    return int(r.headers['Content-Length'])
+
+def downloadMonth(YEAR, MONTH, session=None, baseUrl=BTS_URL, directory='ReferenceTables', blockSize=1 << 20):
+    # Inputs:
+    # YEAR, MONTH: period of flights to download
+    # session: requests session to download with (one is made if not given)
+    # baseUrl: location of the On-Time archives
+    # directory: where the zip is saved
+    # blockSize: bytes written to disk at a time
+
+    # Outputs:
+    # Location of the downloaded zip
+
+    # A month already on disk is only downloaded again if it doesn't match the
+    # size of the remote file, or isn't a readable zip. Downloads are streamed
+    # to a .part file, which is resumed with an HTTP range request if an
+    # earlier download was interrupted, and renamed once complete.
+    session = session or makeSession(1)
+    url = onTimeURL(YEAR, MONTH, baseUrl)
+    zipLoc = onTimeZipLocation(YEAR, MONTH, directory)
+    partLoc = zipLoc + '.part'
+    with metrics.stage('download'):
+        size = remoteSize(session, url)
+
+    if os.path.exists(zipLoc):
+        if (size is None or os.path.getsize(zipLoc) == size) and zipfile.is_zipfile(zipLoc):
+            return zipLoc
+        os.remove(zipLoc)
+
+    os.makedirs(directory, exist_ok=True)
+    done = os.path.getsize(partLoc) if os.path.exists(partLoc) else 0
+    if size is not None and done > size:
+        done = 0
+    with metrics.stage('download'):
+        if size is None or done < size:
+            headers = {'Range': f'bytes={done}-'} if done else {}
+            with session.get(url, headers=headers, stream=True, allow_redirects=True, verify=False, timeout=60) as r:
+                if r.status_code == 416:
+                    # Nothing left to fetch; the size check below decides
+                    pass
+                else:
+                    r.raise_for_status()
+                    # A server that ignores the range sends the whole file again
+                    mode = 'ab' if r.status_code == 206 else 'wb'
+                    with open(partLoc, mode) as f:
+                        for block in r.iter_content(blockSize):
+                            f.write(block)
+
+    if size is not None and os.path.getsize(partLoc) != size:
+        raise IOError(f'Incomplete download of {url}: got {os.path.getsize(partLoc)} of {size} bytes')
+    if not zipfile.is_zipfile(partLoc):
+        os.remove(partLoc)
+        raise IOError(f'Download of {url} is not a zip file')
+    os.replace(partLoc, zipLoc)
+    return zipLoc
+
+def downloadMonths(months, connections=4, baseUrl=BTS_URL, directory='ReferenceTables'):
+    # Downloads several months concurrently, over at most `connections`
+    # connections. Yields ((YEAR, MONTH), zip location or exception) as each
+    # download finishes.
+    session = makeSession(connections)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as pool:
+        futures = {pool.submit(downloadMonth, YEAR, MONTH, session, baseUrl, directory): (YEAR, MONTH) for YEAR, MONTH in months}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+class TimedReader(io.RawIOBase):
+    # Raw stream over a file in a zip, timing its decompression as the unzip
+    # stage of the run metrics
+    def __init__(self, raw):
+        self.raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        with metrics.stage('unzip'):
+            return self.raw.readinto(buffer)
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+def openOnTimeCSV(zipLoc):
+    # Opens the On-Time CSV inside a downloaded zip for reading, without
+    # extracting it to disk
+    with zipfile.ZipFile(zipLoc) as zipRef:
+        name = next(n for n in zipRef.namelist() if n.lower().endswith('.csv'))
+        return io.BufferedReader(TimedReader(zipRef.open(name)), 1 << 20)
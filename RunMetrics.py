@@ -0,0 +1,113 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+import collections
+
+# Stages of a run whose wall time is measured, in pipeline order:
+# download: fetching (or checking) the On-Time zip
+# unzip: decompressing the On-Time CSV out of the zip
+# CSV parse: parsing the On-Time CSV into DataFrames
+# reference-table ingest: loading (or compiling) the reference tables
+# LTO lookup: tail number -> engine -> LTO rates resolution
+# LTO emissions, CCD interpolation: the two halves of emissions_vectorized
+# output write: writing and finalizing the results file
+STAGES = ['download', 'unzip', 'CSV parse', 'reference-table ingest', 'LTO lookup', 'LTO emissions',
+          'CCD interpolation', 'output write']
+
+class RunMetrics:
+    # Wall time per stage and named counters of a run, safe to update from
+    # several threads. Time spent in a stage nested within another (e.g. unzip
+    # within CSV parse) only counts towards the inner one, so that stages add
+    # up to at most the wall time of each thread.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.seconds = collections.defaultdict(float)
+            self.calls = collections.defaultdict(int)
+            self.counters = collections.defaultdict(int)
+            self.memory = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.add(name, elapsed - nested)
+
+    def add(self, name, seconds, calls=1):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += calls
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += int(n)
+
+    def report(self):
+        # Plain dict of the metrics, ready to be saved as JSON
+        with self.lock:
+            names = [s for s in STAGES if s in self.seconds] + sorted(s for s in self.seconds if s not in STAGES)
+            report = {'stages': {name: {'seconds': round(self.seconds[name], 6), 'calls': self.calls[name]} for name in names},
+                      'counters': dict(sorted(self.counters.items()))}
+            if self.memory is not None:
+                report['memory'] = self.memory
+            return report
+
+    def merge(self, report):
+        # Adds in the report of another process, e.g. a backfill worker
+        for name, stage in report['stages'].items():
+            self.add(name, stage['seconds'], stage['calls'])
+        for name, n in report['counters'].items():
+            self.count(name, n)
+
+# Metrics of the current process, updated by every stage of the pipeline
+metrics = RunMetrics()
+
+@contextlib.contextmanager
+def profiled(profileLoc=None, traceMemory=False):
+    # Runs the enclosed code under cProfile, saving its stats to profileLoc
+    # (readable with pstats or snakeviz), and/or under tracemalloc, recording
+    # the peak traced memory and the top allocation sites into metrics
+    profiler = cProfile.Profile() if profileLoc else None
+    if traceMemory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(os.path.dirname(profileLoc) or '.', exist_ok=True)
+            profiler.dump_stats(profileLoc)
+        if traceMemory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+            metrics.memory = {'peak MB': round(peak / 2**20, 3), 'current MB': round(current / 2**20, 3),
+                              'top allocations': [{'site': str(s.traceback), 'MB': round(s.size / 2**20, 3)} for s in top]}
+
+def printProfile(profileLoc, lines=20):
+    pstats.Stats(profileLoc).sort_stats('cumulative').print_stats(lines)
+
+def saveReport(report, saveLoc):
+    os.makedirs(os.path.dirname(saveLoc) or '.', exist_ok=True)
+    with open(saveLoc, 'w') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
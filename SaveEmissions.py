@@ -0,0 +1,153 @@
+import os
+import pandas as pd
+from RunMetrics import metrics
+
+# Output formats supported by EmissionsWriter
+FORMATS = ['csv', 'parquet', 'feather']
+
+# Columns added to the On-Time dataset by emissions_batch
+EMISSIONS_COLUMNS = ['Total CO2', 'Total CO2E', 'Number Seats', 'Origin LTO CO2', 'Origin LTO CO2e',
+                     'Destination LTO CO2', 'Destination LTO CO2e', 'Airplane Manu Year',
+                     'Total_HC_lto', 'Total_CO_lto', 'Total_NOx_lto', 'Total_CO2_lto', 'Total_CO2_ccd',
+                     'Total_NOx_ccd', 'Total_SOx_ccd', 'Total_H2O_ccd', 'Total_CO_ccd', 'Total_HC_ccd']
+
+# Columns with few distinct values, stored as categoricals in Parquet/Feather
+CATEGORICAL_COLUMNS = ['Reporting_Airline', 'Tail_Number', 'Origin', 'Dest']
+
+def datasetLocation(outputFormat):
+    # Root of the Parquet or Feather dataset, holding nothing but results, so
+    # that it can be opened as a whole, e.g. with
+    # pyarrow.dataset.dataset(datasetLocation('parquet'), partitioning='hive')
+    return f'Results/OnTimeEmissions.{outputFormat}'
+
+def resultsLocation(YEAR, MONTH, outputFormat='csv'):
+    # CSV results keep their original location. Parquet and Feather results are
+    # partitioned by year and month (year=YYYY/month=M) under their dataset
+    # root, so that dataset readers such as pyarrow.dataset only open the
+    # months a query needs.
+    if outputFormat == 'csv':
+        return f'Results/OnTimeEmissions{YEAR}_{MONTH}.csv'
+    return f'{datasetLocation(outputFormat)}/year={YEAR}/month={MONTH}/part-0.{outputFormat}'
+
+def partialLocation(saveLoc):
+    # Results are written under a hidden temporary name next to saveLoc, which
+    # dataset readers skip, and only moved into place once complete
+    directory, name = os.path.split(saveLoc)
+    return os.path.join(directory, f'.{name}.partial')
+
+def arrowSchema(frame):
+    # Arrow schema of a results frame: float32 emissions and dictionary-encoded
+    # carrier, tail number and airport codes
+    import pyarrow as pa
+    schema = pa.Schema.from_pandas(frame, preserve_index=False)
+    for i, field in enumerate(schema):
+        if field.name in EMISSIONS_COLUMNS:
+            schema = schema.set(i, pa.field(field.name, pa.float32()))
+        elif field.name in CATEGORICAL_COLUMNS:
+            schema = schema.set(i, pa.field(field.name, pa.dictionary(pa.int32(), pa.string())))
+    return schema.remove_metadata()
+
+class EmissionsWriter:
+    # Writes a month of results, one chunk of flights at a time.
+    # Inputs:
+    # saveLoc: location of the file to write
+    # outputFormat: one of FORMATS
+    # columns: columns to keep, or None to keep every column
+
+    # Chunks are written as they come in, so memory use doesn't grow with
+    # the month. Feather (Arrow IPC) files only allow a column's dictionary to
+    # be extended from one chunk to the next, so categorical columns are
+    # encoded against the values of every chunk written so far.
+    def __init__(self, saveLoc, outputFormat='csv', columns=None):
+        if outputFormat not in FORMATS:
+            raise ValueError(f'Unknown output format {outputFormat!r}, expected one of {FORMATS}')
+        self.saveLoc = saveLoc
+        self.outputFormat = outputFormat
+        self.columns = columns
+        self.schema = None
+        self.parquetWriter = None
+        self.featherWriter = None
+        self.categories = {}
+        self.chunks = 0
+
+    def write(self, chunk):
+        with metrics.stage('output write'):
+            if self.columns is not None:
+                chunk = chunk[[c for c in self.columns if c in chunk.columns]]
+            if self.outputFormat == 'csv':
+                chunk.to_csv(self.saveLoc, mode='w' if self.chunks == 0 else 'a', header=(self.chunks == 0))
+            else:
+                import pyarrow as pa
+                if self.schema is None:
+                    self.schema = arrowSchema(chunk)
+                if self.outputFormat == 'parquet':
+                    import pyarrow.parquet as pq
+                    if self.parquetWriter is None:
+                        self.parquetWriter = pq.ParquetWriter(self.saveLoc, self.schema, compression='zstd')
+                    self.parquetWriter.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+                else:
+                    import pyarrow.ipc as ipc
+                    if self.featherWriter is None:
+                        options = ipc.IpcWriteOptions(compression='zstd', emit_dictionary_deltas=True)
+                        self.featherWriter = ipc.new_file(self.saveLoc, self.schema, options=options)
+                    chunk = self.extendCategories(chunk)
+                    self.featherWriter.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+            self.chunks += 1
+
+    def extendCategories(self, chunk):
+        # Re-encodes the categorical columns of a chunk against every value
+        # seen so far, new values appended at the end
+        chunk = chunk.copy()
+        for column in CATEGORICAL_COLUMNS:
+            if column in chunk:
+                values = chunk[column].astype(object)
+                known = self.categories.get(column, pd.Index([], dtype=object))
+                known = known.append(pd.Index(values.dropna().unique(), dtype=object).difference(known))
+                self.categories[column] = known
+                chunk[column] = pd.Categorical.from_codes(known.get_indexer(values), known)
+        return chunk
+
+    def close(self):
+        with metrics.stage('output write'):
+            if self.parquetWriter is not None:
+                self.parquetWriter.close()
+                self.parquetWriter = None
+            if self.featherWriter is not None:
+                self.featherWriter.close()
+                self.featherWriter = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def readResults(saveLoc, columns=None, chunksize=500000):
+    # Reads back results written by EmissionsWriter, yielding DataFrames of at
+    # most chunksize flights, with only those of the given columns that were
+    # saved, if any
+    if saveLoc.endswith('.csv'):
+        usecols = None if columns is None else lambda c: c in columns
+        yield from pd.read_csv(saveLoc, usecols=usecols, chunksize=chunksize, index_col=None if columns else 0)
+    elif saveLoc.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        parquetFile = pq.ParquetFile(saveLoc)
+        if columns is not None:
+            columns = [c for c in columns if c in parquetFile.schema_arrow.names]
+        for batch in parquetFile.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        # Feather files hold a record batch per chunk written, each read (and
+        # decompressed) on its own
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        with pa.memory_map(saveLoc) as source:
+            reader = ipc.open_file(source)
+            if columns is not None:
+                columns = [c for c in columns if c in reader.schema.names]
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if columns is not None:
+                    batch = batch.select(columns)
+                for offset in range(0, batch.num_rows, chunksize):
+                    yield batch.slice(offset, chunksize).to_pandas()
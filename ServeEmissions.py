@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import urllib.parse
+import numpy as np
+import pandas as pd
+from CalculateEmissions import (TIME_TAKEOFF, TIME_CLIMB, TIME_APPROACH, REFERENCE_TABLES, readReferenceTables,
+                                referenceTablesKey, emissions_calc, emissions_batch, flight_emissions, EmissionsCache)
+
+# Python counterpart of MATLAB/flight_emissions.m as a long-running local
+# HTTP/JSON service. The compiled reference tables are loaded once, and
+# reloaded in the background whenever a file in ReferenceTables/ changes.
+#
+# GET  /health                 state of the service
+# GET  /estimate?tail=N815DN&TaxiIn=7&TaxiOut=15&AirTime=124
+# POST /estimate               {"tail": "N815DN", "TaxiIn": 7, "TaxiOut": 15, "AirTime": 124}
+# POST /estimate/batch         {"flights": [{"tail": ..., ...}, ...]}
+#
+# TaxiIn, TaxiOut and AirTime are in minutes, as in the On-Time dataset.
+# timeTakeoff, timeClimb and timeApproach (in seconds) can also be given,
+# and default to the standard LTO times.
+
+# Outputs of emissions_calc, in order
+CALC_COLUMNS = ['Total CO2', 'Total CO2E', 'Origin LTO CO2', 'Origin LTO CO2e', 'Destination LTO CO2',
+                'Destination LTO CO2e', 'Total_HC_lto', 'Total_CO_lto', 'Total_NOx_lto', 'Total_CO2_lto',
+                'Total_CO2_ccd', 'Total_NOx_ccd', 'Total_SOx_ccd', 'Total_H2O_ccd', 'Total_CO_ccd', 'Total_HC_ccd']
+
+# Batches of at most this many flights are computed on the event loop; larger
+# ones in a worker thread, so that they don't hold up other requests
+INLINE_BATCH = 256
+
+# Largest request body accepted, in bytes
+MAX_BODY = 64 << 20
+
+# Longest phase time accepted: a day, in minutes for TaxiIn, TaxiOut and
+# AirTime and in seconds for the LTO times
+MAX_MINUTES = 24 * 60
+MAX_SECONDS = 24 * 60 * 60
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+def parseFlight(flight):
+    # Validates a flight given as a dict, returning (tail, TaxiIn, TaxiOut,
+    # AirTime, timeTakeoff, timeClimb, timeApproach)
+    if not isinstance(flight, dict) or not isinstance(flight.get('tail'), str):
+        raise ValueError('each flight needs a "tail" number')
+    values = []
+    for name, default, limit in [('TaxiIn', None, MAX_MINUTES), ('TaxiOut', None, MAX_MINUTES), ('AirTime', None, MAX_MINUTES),
+                                 ('timeTakeoff', TIME_TAKEOFF, MAX_SECONDS), ('timeClimb', TIME_CLIMB, MAX_SECONDS),
+                                 ('timeApproach', TIME_APPROACH, MAX_SECONDS)]:
+        value = flight.get(name, default)
+        if value is None:
+            raise ValueError(f'missing "{name}"')
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'"{name}" must be a number, got {value!r}')
+        if not 0 <= value <= limit:
+            raise ValueError(f'"{name}" must be a number from 0 to {limit}, got {value!r}')
+        values.append(value)
+    return (flight['tail'].strip().upper(), *values)
+
+def isStandard(times):
+    return times == (TIME_TAKEOFF, TIME_CLIMB, TIME_APPROACH)
+
+def jsonValue(value):
+    # NaN (e.g. an unknown manufacture year) and infinities aren't valid JSON
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+def describe(tail, entry, results):
+    # Result of a flight, as returned by the service
+    estimate = {'tail': tail, 'Standard Code': entry['Standard Code'], 'Number Seats': entry['Number of Seats'],
+                'FAA Engine Code': entry['FAA Engine Code'], 'Airplane Manu Year': jsonValue(entry['Manufacture Year'])}
+    estimate.update({column: jsonValue(value) for column, value in zip(CALC_COLUMNS, results)})
+    estimate['Carbon Footprint'] = jsonValue(results[1] / entry['Number of Seats']) if entry['Number of Seats'] else None
+    return estimate
+
+def estimateFlight(flight, tables, cache=None):
+    # Inputs:
+    # flight: tail number and phase times of a flight, as a dict
+    # tables: reference tables, as returned by readReferenceTables
+    # cache: optional EmissionsCache, used with the standard LTO times
+
+    # Outputs:
+    # Estimate of the flight, raising KeyError if its tail number is unknown
+    fleet, ltoRates, ccdIndex = tables
+    tail, TaxiIn, TaxiOut, AirTime, *times = parseFlight(flight)
+    tailID = fleet.find(tail)
+    if tailID < 0:
+        raise KeyError(tail)
+    entry = fleet.entry(tailID)
+    if isStandard(tuple(times)):
+        results = flight_emissions(entry['FAA Engine Code'], entry['Standard Code'], TaxiIn, TaxiOut, AirTime, ltoRates, ccdIndex, cache=cache)
+    else:
+        timeTakeoff, timeClimb, timeApproach = times
+        timeCCD = AirTime - ((timeTakeoff + timeClimb + timeApproach)/60)
+        results = emissions_calc(entry['FAA Engine Code'], entry['Standard Code'], timeTakeoff, timeClimb, timeApproach, 60*TaxiIn, 60*TaxiOut, timeCCD, ltoRates, ccdIndex)
+    return describe(tail, entry, results)
+
+def estimateFlights(flights, tables):
+    # Estimates of a batch of flights, in order, with an "error" entry for
+    # each flight that is invalid or has an unknown tail number. Flights with
+    # the standard LTO times are computed together with emissions_batch.
+    fleet, ltoRates, ccdIndex = tables
+    estimates = [None] * len(flights)
+    valid = []
+    for i, flight in enumerate(flights):
+        try:
+            valid.append((i, flight, parseFlight(flight)))
+        except ValueError as e:
+            estimates[i] = {'error': str(e)}
+
+    standard = []
+    tailIDs = fleet.lookup([parsed[0] for _, _, parsed in valid])
+    for (i, flight, parsed), tailID in zip(valid, tailIDs):
+        if tailID < 0:
+            estimates[i] = {'tail': parsed[0], 'error': 'unknown tail number'}
+        elif isStandard(parsed[4:]):
+            standard.append((i, parsed, tailID))
+        else:
+            estimates[i] = estimateFlight(flight, tables)
+
+    if standard:
+        onTime = pd.DataFrame([parsed[:4] for _, parsed, _ in standard], columns=['Tail_Number', 'TaxiIn', 'TaxiOut', 'AirTime'])
+        results = emissions_batch(onTime, fleet, ltoRates, ccdIndex)
+        values = results[CALC_COLUMNS].to_numpy()
+        for j, (i, parsed, tailID) in enumerate(standard):
+            estimates[i] = describe(parsed[0], fleet.entry(tailID), values[j])
+    return estimates
+
+def referenceTablesSignature():
+    # Cheap fingerprint of ReferenceTables/, compared every few seconds to
+    # detect changes without rehashing the workbooks
+    signature = []
+    for name in REFERENCE_TABLES:
+        try:
+            stat = os.stat(os.path.join('ReferenceTables', name))
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append((name, None, None))
+    return signature
+
+def loadReferenceTables():
+    # Reference tables together with the key of the sources they come from
+    return readReferenceTables(None), referenceTablesKey()
+
+class EmissionsService:
+    # Inputs:
+    # cacheSize: size of the EmissionsCache of single estimates (0 disables it)
+    # reloadInterval: seconds between checks of ReferenceTables/ (0 disables
+    # hot reload)
+
+    # Requests are served from the tables loaded last. A reload compiles the
+    # new tables in a worker thread and swaps them in at once, so requests
+    # keep being served, from the old tables, in the meantime.
+    def __init__(self, cacheSize=100000, reloadInterval=2):
+        self.cacheSize = cacheSize
+        self.reloadInterval = reloadInterval
+        self.requests = 0
+        self.load(*loadReferenceTables())
+        self.signature = referenceTablesSignature()
+
+    def load(self, tables, key):
+        self.tables = tables
+        self.cache = EmissionsCache(self.cacheSize) if self.cacheSize else None
+        self.key = key
+        self.loaded = time.time()
+
+    async def watchReferenceTables(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.reloadInterval)
+            signature = referenceTablesSignature()
+            if signature == self.signature:
+                continue
+            # A failed reload (e.g. a workbook saved halfway) keeps the old
+            # tables, and is retried on the next change
+            self.signature = signature
+            print('Reference tables changed, reloading...')
+            try:
+                tables, key = await loop.run_in_executor(None, loadReferenceTables)
+            except Exception as e:
+                print(f'Failed to reload reference tables: {e!r}')
+                continue
+            self.load(tables, key)
+            print(f'Reloaded reference tables {self.key[:12]}')
+
+    def health(self):
+        return {'status': 'ok', 'reference tables': self.key, 'loaded': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.loaded)),
+                'tails': len(self.tables[0]), 'requests': self.requests, 'cache': self.cache.info() if self.cache else None}
+
+    async def route(self, method, target, body):
+        # Returns the status and JSON payload of a request
+        url = urllib.parse.urlsplit(target)
+        try:
+            if url.path == '/health' and method == 'GET':
+                return 200, self.health()
+            if url.path == '/estimate' and method in ('GET', 'POST'):
+                if method == 'GET':
+                    flight = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+                else:
+                    flight = json.loads(body)
+                try:
+                    return 200, estimateFlight(flight, self.tables, self.cache)
+                except KeyError:
+                    return 404, {'error': 'unknown tail number', 'tail': flight['tail']}
+            if url.path == '/estimate/batch' and method == 'POST':
+                flights = json.loads(body).get('flights')
+                if not isinstance(flights, list):
+                    raise ValueError('expected {"flights": [...]}')
+                if len(flights) <= INLINE_BATCH:
+                    estimates = estimateFlights(flights, self.tables)
+                else:
+                    estimates = await asyncio.get_running_loop().run_in_executor(None, estimateFlights, flights, self.tables)
+                return 200, {'results': estimates}
+            if url.path in ('/health', '/estimate', '/estimate/batch'):
+                return 405, {'error': f'{method} not allowed on {url.path}'}
+            return 404, {'error': f'no such endpoint {url.path}'}
+        except (ValueError, AttributeError) as e:
+            # Includes malformed JSON (json.JSONDecodeError is a ValueError)
+            return 400, {'error': str(e)}
+
+    async def handle(self, reader, writer):
+        # Serves the requests of one connection, keeping it open between
+        # requests (HTTP/1.1 keep-alive) unless the client asks otherwise
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine.strip():
+                    break
+                method, target, version = requestLine.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, payload = 413, {'error': f'request body over {MAX_BODY} bytes'}
+                else:
+                    body = await reader.readexactly(length)
+                    self.requests += 1
+                    try:
+                        status, payload = await self.route(method, target, body)
+                    except Exception as e:
+                        status, payload = 500, {'error': repr(e)}
+
+                keepAlive = status != 413 and headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                data = json.dumps(payload).encode()
+                writer.write((f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                              f'Content-Type: application/json\r\n'
+                              f'Content-Length: {len(data)}\r\n'
+                              f'Connection: {"keep-alive" if keepAlive else "close"}\r\n\r\n').encode() + data)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Client went away, or sent something that isn't HTTP
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        if self.reloadInterval:
+            asyncio.get_running_loop().create_task(self.watchReferenceTables())
+        print(f'Serving emissions estimates on http://{host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Emissions Service")
+    parser.add_argument("--host", help="Address to listen on", default='127.0.0.1')
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8080)
+    parser.add_argument("--cache-size", help="Memoize the single estimates of up to this many distinct inputs (0 disables); repeated inputs are ~10x faster, new ones ~15%% slower, and batches are never memoized", type=int, default=100000)
+    parser.add_argument("--reload-interval", help="Seconds between checks of ReferenceTables/ for changes (0 disables hot reload)", type=float, default=2)
+    args = parser.parse_args()
+
+    print('Ingesting Reference Tables...')
+    service = EmissionsService(args.cache_size, args.reload_interval)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
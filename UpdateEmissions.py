@@ -0,0 +1,184 @@
+import os
+import glob
+import json
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from CalculateEmissions import (readReferenceTables, emissions_batch, monthRange, snapshotReferenceTables, loadTablesSnapshot,
+                                dependenciesLocation, loadDependencies, recordDependencies, tablesSnapshotLocation)
+from SaveEmissions import FORMATS, EMISSIONS_COLUMNS, EmissionsWriter, resultsLocation, partialLocation, readResults
+
+# Brings stored results up to date with the reference tables without
+# recalculating every month. Each results file records the tables it was
+# calculated with and the tail numbers, FAA engine codes and Standard Codes it depends on
+# (see recordDependencies). After the reference tables change, the old and new
+# tables are compared, and only the flights whose inputs changed are
+# recalculated and patched into the stored results.
+
+def sameValue(old, new):
+    # Equality of two table entries, where NaN equals NaN and None (missing)
+    # equals nothing but None
+    if old is None or new is None:
+        return old is None and new is None
+    if isinstance(old, tuple):
+        return all(sameValue(a, b) for a, b in zip(old, new)) and len(old) == len(new)
+    return np.array_equal(np.asarray(old), np.asarray(new), equal_nan=True)
+
+def diffReferenceTables(old, new):
+    # Inputs:
+    # old, new: reference tables, as returned by readReferenceTables
+
+    # Outputs:
+    # Tail numbers, FAA engine codes and Standard Codes whose flights may have
+    # different emissions under the new tables:
+    # tail numbers: engine table entry or manufacture year changed (or added,
+    # or removed)
+    # engine codes: LTO rates changed
+    # standard codes: CCD data or LTO Backup rates changed
+    oldFleet, oldLTO, oldCCD = old
+    newFleet, newLTO, newCCD = new
+
+    tails = np.union1d(oldFleet.tails, newFleet.tails)
+    oldIDs, newIDs = oldFleet.lookup(tails), newFleet.lookup(tails)
+    changedTails = (oldIDs < 0) | (newIDs < 0)
+    for name in ['types', 'seats', 'engines', 'years']:
+        oldValues, newValues = getattr(oldFleet, name)[oldIDs], getattr(newFleet, name)[newIDs]
+        changedTails |= (oldValues != newValues) & ~(pd.isna(oldValues) & pd.isna(newValues))
+    tails = set(tails[changedTails].tolist())
+
+    def rates(ltoRates, row):
+        return None if row is None else ltoRates['Rates'][row]
+    engines = {code for code in oldLTO['Row'].keys() | newLTO['Row'].keys()
+               if not sameValue(rates(oldLTO, oldLTO['Row'].get(code)), rates(newLTO, newLTO['Row'].get(code)))}
+    airplanes = {airplane for airplane in oldLTO['Backup Row'].keys() | newLTO['Backup Row'].keys()
+                 if not sameValue(rates(oldLTO, oldLTO['Backup Row'].get(airplane)), rates(newLTO, newLTO['Backup Row'].get(airplane)))}
+    airplanes |= {airplane for airplane in oldCCD.keys() | newCCD.keys() if not sameValue(oldCCD.get(airplane), newCCD.get(airplane))}
+    return {'tail numbers': tails, 'engine codes': engines, 'standard codes': airplanes}
+
+def monthAffected(dependencies, changed):
+    # Whether any flight of a month may be affected by the changes
+    return any(set(dependencies[name]) & changed[name] for name in ['tail numbers', 'engine codes', 'standard codes'])
+
+def affectedFlights(tails, fleet, changed):
+    # Boolean mask of the flights (given by their tail numbers) to recalculate.
+    # Tails whose entry changed are in changed['tail numbers'], so every other
+    # tail has the same engine and airplane type under the old and new tables.
+    tailCodes, uniqueTails = pd.factorize(tails)
+    tailIDs = fleet.lookup(uniqueTails)
+    affected = np.isin(np.asarray(uniqueTails, dtype=str), list(changed['tail numbers']))
+    affected |= (tailIDs >= 0) & (np.isin(fleet.engines[tailIDs], list(changed['engine codes'])) |
+                                  np.isin(fleet.types[tailIDs], list(changed['standard codes'])))
+    return np.append(affected, False)[tailCodes]
+
+def readStoredResults(saveLoc, chunksize):
+    # Stored results, chunksize flights at a time. CSV results are read as
+    # text, so that every value that isn't recalculated is written back
+    # exactly as it was.
+    if saveLoc.endswith('.csv'):
+        yield from pd.read_csv(saveLoc, dtype=str, keep_default_na=False, index_col=0, chunksize=chunksize)
+    else:
+        yield from readResults(saveLoc, chunksize=chunksize)
+
+def patchMonth(saveLoc, outputFormat, tables, changed, chunksize=500000):
+    # Recalculates the affected flights of a month's results with tables, and
+    # moves the patched results into place. Returns the number of flights
+    # recalculated.
+    fleet, ltoRates, ccdIndex = tables
+    partialLoc = partialLocation(saveLoc)
+    patched = 0
+    with EmissionsWriter(partialLoc, outputFormat) as writer:
+        for chunk in readStoredResults(saveLoc, chunksize):
+            tails = chunk['Tail_Number'].astype(object).replace('', np.nan)
+            affected = affectedFlights(tails, fleet, changed)
+            if affected.any():
+                flights = pd.DataFrame({'Tail_Number': tails[affected]})
+                for column in ['TaxiIn', 'TaxiOut', 'AirTime']:
+                    flights[column] = pd.to_numeric(chunk.loc[affected, column].replace('', np.nan))
+                results = emissions_batch(flights, fleet, ltoRates, ccdIndex)
+                for column in EMISSIONS_COLUMNS:
+                    if column in chunk:
+                        values = results[column].to_numpy()
+                        if pd.api.types.is_string_dtype(chunk[column]):
+                            # Text columns of a CSV; NaN is written out as an empty field
+                            chunk[column] = chunk[column].astype(object)
+                        else:
+                            # e.g. float32 columns of Parquet and Feather results
+                            values = values.astype(chunk[column].dtype)
+                        chunk.loc[affected, column] = values
+                patched += affected.sum()
+            writer.write(chunk)
+    os.replace(partialLoc, saveLoc)
+    return int(patched)
+
+def updateMonth(YEAR, MONTH, outputFormat, tables, chunksize=500000, diffs=None):
+    # Inputs:
+    # YEAR, MONTH: stored month to update
+    # outputFormat: format its results were saved in
+    # tables: current reference tables
+    # diffs: dict memoizing diffReferenceTables by snapshot digest, shared
+    # across months
+
+    # Outputs:
+    # Description of what was done
+    saveLoc = resultsLocation(YEAR, MONTH, outputFormat)
+    if not os.path.exists(saveLoc):
+        return 'no results'
+    dependencies = loadDependencies(saveLoc)
+    if dependencies is None:
+        return 'no dependencies recorded; recalculate it, or record it with --assume-current'
+    digest = snapshotReferenceTables(tables)
+    if dependencies['reference tables'] == digest:
+        return 'up to date'
+
+    diffs = {} if diffs is None else diffs
+    if dependencies['reference tables'] not in diffs:
+        old = loadTablesSnapshot(dependencies['reference tables'])
+        diffs[dependencies['reference tables']] = None if old is None else diffReferenceTables(old, tables)
+    changed = diffs[dependencies['reference tables']]
+    if changed is None:
+        return 'snapshot of its reference tables is missing; recalculate it'
+
+    patched = patchMonth(saveLoc, outputFormat, tables, changed, chunksize) if monthAffected(dependencies, changed) else 0
+    recordDependencies(saveLoc, dependencies['tail numbers'], tables)
+    return f'{patched} flights recalculated'
+
+def assumeCurrent(YEAR, MONTH, outputFormat, tables):
+    # Records the dependencies of results saved before they were tracked,
+    # taking them to be calculated with the current tables
+    saveLoc = resultsLocation(YEAR, MONTH, outputFormat)
+    tails = set()
+    for chunk in readResults(saveLoc, columns=['Tail_Number']):
+        tails.update(chunk['Tail_Number'].dropna().unique())
+    recordDependencies(saveLoc, tails, tables)
+
+def pruneSnapshots():
+    # Removes the snapshots of reference tables no results file, in any
+    # format, depends on anymore
+    referenced = set()
+    for dependenciesLoc in glob.glob(dependenciesLocation('Results/**/*'), recursive=True):
+        with open(dependenciesLoc) as f:
+            referenced.add(json.load(f)['reference tables'])
+    for snapshotLoc in glob.glob(tablesSnapshotLocation('*')):
+        if os.path.basename(snapshotLoc) not in referenced:
+            shutil.rmtree(snapshotLoc, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("Incremental Emissions Update")
+    parser.add_argument("--from", dest="start", help="First month to update, as YYYY-MM", required=True)
+    parser.add_argument("--to", dest="end", help="Last month to update, as YYYY-MM (defaults to --from)")
+    parser.add_argument("--format", help="Format the results were saved in", choices=FORMATS, default='csv')
+    parser.add_argument("--chunksize", help="Flights patched at a time", type=int, default=500000)
+    parser.add_argument("--assume-current", help="Record the dependencies of months saved before they were tracked, as calculated with the current tables", action="store_true")
+    args = parser.parse_args()
+
+    print('Ingesting Reference Tables...')
+    tables = readReferenceTables(None)
+    diffs = {}
+    for YEAR, MONTH in monthRange(args.start, args.end or args.start):
+        saveLoc = resultsLocation(YEAR, MONTH, args.format)
+        if args.assume_current and os.path.exists(saveLoc) and loadDependencies(saveLoc) is None:
+            assumeCurrent(YEAR, MONTH, args.format, tables)
+        print(f'{MONTH}, {YEAR}: {updateMonth(YEAR, MONTH, args.format, tables, args.chunksize, diffs)}')
+    pruneSnapshots()
+    print('Complete!')